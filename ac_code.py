@@ -5,19 +5,21 @@ print("ok", flush=True)
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy as sp
 import pandas as pd
 import h5py 
 import functools
 import importlib
 
-from scipy.sparse.linalg import LinearOperator
-from scipy.sparse.linalg import lgmres
-
 import spm.utils as utils
 import spm.spm   as spm
+import spm.electrostatics as electrostatics
+import spm.neighbor as neighbor
+import spm.solute as solute
 def reload():
     importlib.reload(utils)
+    importlib.reload(electrostatics)
+    importlib.reload(neighbor)
+    importlib.reload(solute)
     importlib.reload(spm)
 
 # main function
@@ -26,7 +28,7 @@ def solver(phi, uk, position, rotation, velocity, omega, \
                    phiFunc, fluidSolver, posSolver, velSolver, potentialSolver):
     # 1 - solute concentration
     phi_s               =   sys.makePhi(phi_sine, position) 
-    charge              =   np.array([solverC(ci, sys.ifftu(uk) , position, electricfield, gi, zi, phi_s) for ci,gi,zi in zip(charge, gamma, ze)])
+    charge              =   chargeSolver.step(charge, sys.ifftu(uk), migrationField(electricfield), phi_s, dt)
     rho_e               =   sys.makeRhoe_complex(charge, ze, phi_s)
     
     # 2 - advection / diffusion
@@ -42,13 +44,14 @@ def solver(phi, uk, position, rotation, velocity, omega, \
     potential, electricfield, rho_b, f_maxwell, rho_e  =   potentialSolver(eps, Ext, rho_e, deps, electric_potential-potential_ext)
     potential          +=   potential_ext
     electricfield      +=   Ext 
-    uk                  =   uk + dt*np.einsum('ij...,j...->i...', PKsole, sys.fftu(f_maxwell))
+    uk                  =   uk + dt*sys.grid.projectSolenoidal(sys.fftu(f_maxwell))
     sys.momentumConservation(uk)
     #uk                  =   solverEHD(uk, rho_e, electricfield, deps); uk[:,0,0] = 0
     
     # 4 - hydrodynamic forces
     u                   =   sys.ifftu(uk)
     force_h, torque_h   =   sys.makeForceHydro(phiFunc, u, position, velocity, omega)
+    force_h            +=   dt*neighbor.softCoreForce(position, neighbors.update(position), sys.grid.length, **repulsion)
     #force_g, torque_g = sys.makeForceGravity(phiFunc, np.array([0.0, -1e-2, 0.0])*(sys.particle.volume*(sys.particle.rho - sys.fluid.rho)), position)
     
     # 5 - update velocities
@@ -56,7 +59,7 @@ def solver(phi, uk, position, rotation, velocity, omega, \
     u                   =   sys.makeUp(phiFunc, position, velocity, omega) - phi[None,...]*u   
     
     # 6 - particle constraint force
-    uk                  = uk + np.einsum('ij...,j...->i...', PKsole, sys.fftu(u))
+    uk                  = uk + sys.grid.projectSolenoidal(sys.fftu(u))
     sys.momentumConservation(uk)
     
     return phi, uk, position, rotation, velocity, omega, force_h/dt, torque_h/dt, \
@@ -64,10 +67,27 @@ def solver(phi, uk, position, rotation, velocity, omega, \
 
 # fluid & particle dynamics
 def solverNS(uk):
-    gnl    = -1j*np.einsum('ij...,k...,kj...->i...', PKsole, sys.grid.K, sys.makeAdvectionK(uk))
+    gnl    = sys.makeProjectedAdvectionK(uk, out=sys.buffer('gnl', uk.shape, complex), rotational=rotational_advection)
     ukstar = np.stack([phihL[0]*uk_d + dt*phihL[1]*gnl_d for uk_d,gnl_d in zip(uk,gnl)])
     return ukstar
 
+def solverNS_etdrk2(uk):
+    advection = lambda v : sys.makeProjectedAdvectionK(v, rotational=rotational_advection)
+    gnl0   = advection(uk)
+    uka    = phihL[0]*uk + dt*phihL[1]*gnl0
+    return uka + dt*phihL[2]*(advection(uka) - gnl0)
+
+def solverNS_etdrk4(uk):
+    advection = lambda v : sys.makeProjectedAdvectionK(v, rotational=rotational_advection)
+    e1, e2, q, f1, f2, f3 = phihL
+    gnl0   = advection(uk)
+    uka    = e2*uk + dt*q*gnl0
+    gnla   = advection(uka)
+    ukb    = e2*uk + dt*q*gnla
+    gnlb   = advection(ukb)
+    ukc    = e2*uka + dt*q*(2*gnlb - gnl0)
+    return e1*uk + dt*(f1*gnl0 + 2*f2*(gnla + gnlb) + f3*advection(ukc))
+
 def solverEHD(uk, free_charge_density, electricfield, deps):
     def _from_staggered_to_normal(vector):
         dmy = np.zeros_like(vector)
@@ -77,7 +97,7 @@ def solverEHD(uk, free_charge_density, electricfield, deps):
     E_on_normal = _from_staggered_to_normal(electricfield)
     A = free_charge_density[None,...]*E_on_normal
     B = -np.einsum("i...,i...->...", E_on_normal, E_on_normal)*_from_staggered_to_normal(deps)/2
-    return uk + dt*np.einsum('ij...,j...->i...', PKsole, sys.fftu(A+B))
+    return uk + dt*sys.grid.projectSolenoidal(sys.fftu(A+B))
 
 def solverParticlePos(position, velocity, rotation, omega):
     position_new = utils.pbc(position + velocity * dt, sys.grid.length)
@@ -106,81 +126,97 @@ def solverC(charge, u, position, electric_field, gamma, ze, phi_dmy):
     return sys.icffta(chargek - dt*1j*np.einsum("i..., i...->...", sys.grid.K_c, (A-B-C)))
 
 def solverPoisson(eps, Ext, rho_e, deps, potential_in):  
-    # tell how to calculate Ax
-    def mvps(v):
-        w = v.view()
-        w.shape = eps.shape
-        dmy = sys.icfftu(1j*sys.grid.K_c*sys.grid.shiftK_c()*sys.cffta(w))
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps + np.roll(eps, -1, axis=i))
-        dmy = sys.icffta(np.sum(1j*sys.grid.K_c*np.conj(sys.grid.shiftK_c())*sys.cfftu(dmy), axis=0))
-        dmy = dmy.reshape(NN)
-        return dmy
-    # build b
-    def rhs(eps, Ext):
-        dmy = Ext.copy()
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps + np.roll(eps, -1, axis=i))
-        dmy = sys.icffta(np.sum(1j*sys.grid.K_c*np.conj(sys.grid.shiftK_c())*sys.cfftu(dmy), axis=0))
-        dmy = dmy.reshape(NN)
-        return dmy
-    # error count
-    class gmres_counter(object):
-        def __init__(self, disp=True):
-            self._disp = disp
-            self.niter = 0
-        def __call__(self, rk=None):
-            self.niter += 1
-            if self._disp:
-                print('iter %3i\t error = %.3e / %.3e' % (self.niter, np.max(np.abs(mvps(rk)-b)), np.max(np.abs(A*rk -b))))
-    
-    NN            = np.prod(eps.shape)
-    A             = LinearOperator((NN,NN), matvec=mvps, dtype='complex128')
-    b             = rhs(eps, Ext) - rho_e.reshape(NN)
-    counter       = gmres_counter()
-    pot, exitcode = lgmres(A, b, x0=potential_in.reshape(NN), tol=1e-5)#, callback=counter)
-    pot.shape     = eps.shape
-    E             = -sys.icfftu(1j*sys.grid.K_c*sys.grid.shiftK_c()*sys.cffta(pot)) 
+    # div(eps grad) with face averaged eps and shifted symbols built once
+    op = sys.makePoissonOperator(eps, complex_field=True)
+    b             = op.rhs(Ext) - rho_e
+    pot           = poisson_solver.solve(op, b, potential_in)
+    return electrostaticResponse(op, pot, eps, Ext, rho_e, deps)
+
+def solverPoisson_phasor(eps, Ext, rho_e, deps, potential_in):
+    # the potential is linear in Ext = E_0(t) e : reuse the unit field solution while eps (i.e. phi_s) is unchanged
+    op, pot_unit, b_unit, E_0 = phasor_cache.update(eps, Ext)
+    pot           = E_0*pot_unit
+    # free charge contribution, only solved for when it is above the solver tolerance
+    if np.linalg.norm(rho_e) > poisson_solver.tol*np.linalg.norm(E_0*b_unit):
+        pot      += poisson_solver.solve(op, -rho_e, potential_in - pot)
+    return electrostaticResponse(op, pot, eps, Ext, rho_e, deps)
+
+def solverPoisson_basis(eps, Ext, rho_e, deps, potential_in):
+    # superposition of the responses to unit fields along each axis, recomputed only when eps (i.e. phi_s) changes
+    op            = field_basis.update(eps)
+    a             = field_basis.amplitude(Ext)
+    pot           = field_basis.potential(a)
+    E             = field_basis.field(a)
+    rho_b         = field_basis.boundCharge(a)
+    if np.linalg.norm(rho_e) > poisson_solver.tol*np.linalg.norm(field_basis.rhs(a)):
+        pot_e     = poisson_solver.solve(op, -rho_e, potential_in - pot)
+        E_e       = -op.gradient(pot_e)
+        pot      += pot_e
+        E        += E_e
+        rho_b    -= op.divergence(op.faceAverage(eps - 1)*E_e)
+    return electrostaticResponse(op, pot, eps, Ext, rho_e, deps, E, rho_b)
+
+def solverPoisson_sweep(frequencies, position, rotation, phi_s, Ext, rho_e, potential_in=None):
+    # response spectrum : one stacked (block diagonal) solve for all frequencies, with per frequency preconditioners
+    eps, deps     = sys.makeDielectricField_tanh_complex_sweep(em, position, rotation, phi_s, frequencies)
+    op            = sys.makePoissonOperator(eps, complex_field=True)
+    b             = op.rhs(Ext) - rho_e
+    pot           = sweep_solver.solve(op, b, potential_in)
+    # potential, field, bound charge, maxwell force and free charge for each frequency
+    return [electrostaticResponse(sys.makePoissonOperator(eps_f, complex_field=True), pot_f, eps_f, Ext, rho_e.copy(), deps_f) \
+            for eps_f, deps_f, pot_f in zip(eps, deps, pot)]
+
+def migrationField(electric_field):
+    # field driving the solute electromigration. In averaged mode the field is the phasor of a field oscillating at
+    # ac_freq : the concentrations see its cycle average, which vanishes (the linear counterpart of the cycle averaged
+    # maxwell force), instead of the phasor frozen at time = 0 acting as a static field
+    return electric_field if ehd_mode == 'instantaneous' else np.zeros_like(electric_field)
+
+def electrostaticResponse(op, pot, eps, Ext, rho_e, deps, E=None, rho_b=None):
+    # field, ohmic and bound charges, and maxwell force for the potential pot of div(eps grad pot) = div(eps Ext) - rho_e
+    # E, rho_b : induced field and bound charge when already known (e.g. superposed from the field basis)
+    E             = -op.gradient(pot) if E is None else E
     E_total       = E+Ext
     
     def _ohmic_free_charge(E_total, sigma):
-        dmy = E_total.copy()
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(1j*sigma + np.roll(1j*sigma, -1, axis=i))
-        dmy = sys.icffta(np.sum(1j*sys.grid.K_c*np.conj(sys.grid.shiftK_c())*sys.cfftu(dmy), axis=0))
-        return dmy
+        return op.divergence(op.faceAverage(1j*sigma)*E_total)
     dmy     = -_ohmic_free_charge(E_total, eps.imag)
     rho_e  +=  dmy
     
     def _bound_charge_solver(E_total, epsilon0=1):
-        dmy = E_total.copy()
-        eps_minus_eps0 = eps - epsilon0
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps_minus_eps0 + np.roll(eps_minus_eps0, -1, axis=i))
-        dmy = sys.icffta(np.sum(1j*sys.grid.K_c*np.conj(sys.grid.shiftK_c())*sys.cfftu(dmy), axis=0))
-        return dmy
-    rho_b   = -_bound_charge_solver(E_total)
+        return op.divergence(op.faceAverage(eps - epsilon0)*E_total)
+    rho_b   = -_bound_charge_solver(E_total) if rho_b is None else rho_b
     
-    def _solve_maxwell_force(_E, _deps, _free_charge):
+    def _solve_maxwell_force(_E, _deps, _free_charge, average=False):
+        # average : cycle averaged force from the phasors, <f> = 1/2 Re(rho conj(E)) - 1/4 |E|^2 grad eps'
         def _from_staggered_to_normal(vector):
             dmy = np.zeros_like(vector)
             for i in range(len(vector)):
                 dmy[i][...] = 0.5*(vector[i] + np.roll(vector[i], 1, axis=i))
             return dmy
         def _from_normal_to_staggered(scalar, dimention):
-            dmy = np.zeros((dimention,)+ scalar.shape)
+            dmy = np.zeros((dimention,)+ scalar.shape, dtype=scalar.dtype)
             for i in range(dimention):
                 dmy[i][...] = 0.5*(scalar + np.roll(scalar, -1, axis=i))
             return dmy
         dmy = _from_staggered_to_normal(_E)
         #E_2 = np.linalg.norm(dmy, axis=0)
-        E_2 = np.einsum('i...,i...->...', dmy, dmy)
+        if average:
+            E_2 = 0.5*np.einsum('i...,i...->...', dmy, dmy.conj()).real
+        else:
+            E_2 = np.einsum('i...,i...->...', dmy, dmy)
         dmy_stag  = _deps.copy()
         dmy_stag *= -0.5*_from_normal_to_staggered(E_2, len(_E))
-        dmy_stag += _from_normal_to_staggered(_free_charge, len(_E))*_E
+        if average:
+            dmy_stag += 0.5*(_from_normal_to_staggered(_free_charge, len(_E))*_E.conj()).real
+        else:
+            dmy_stag += _from_normal_to_staggered(_free_charge, len(_E))*_E
         dmy_normal = _from_staggered_to_normal(dmy_stag)
         return dmy_stag, dmy_normal
-    f_maxwell_staggered, f_maxwell_normal = _solve_maxwell_force(E_total.real, deps.real, rho_e.real)
+    if ehd_mode == 'averaged':
+        f_maxwell_staggered, f_maxwell_normal = _solve_maxwell_force(E_total, deps.real, rho_e, average=True)
+    else:
+        f_maxwell_staggered, f_maxwell_normal = _solve_maxwell_force(E_total.real, deps.real, rho_e.real)
     
     E.real[...]  = sys.grid.xyzScalar(E.real)
     E.imag[...]  = sys.grid.xyzScalar(E.imag)
@@ -201,14 +237,22 @@ def uniform_ElectricField_y(time, coef_E = .1, frequency=1):
     potential_ext = np.array(np.max(sys.grid.X[1]) - sys.grid.X[1])*E_0
     return Ext, potential_ext
 
+def rotating_ElectricField(time, coef_E = .1, frequency=1):
+    # field rotating in the x-y plane, Re[E_0 (e_x + i e_y)] = coef_E (cos wt, sin wt)
+    E_0  = coef_E*np.exp(-1j*frequency*time)
+    Ext  = np.zeros_like(sys.ifftu(uk), dtype=complex); Ext[0] = 1; Ext[1] = 1j
+    Ext  = E_0*Ext
+    potential_ext = np.array((np.max(sys.grid.X[0]) - sys.grid.X[0]) + 1j*(np.max(sys.grid.X[1]) - sys.grid.X[1]))*E_0
+    return Ext, potential_ext
+
 def ohmic_free_charge(E_total, sigma):
     dmy = E_total.copy()
     for i in range(len(dmy)):
         dmy[i][...] *= 0.5*(1j*sigma + np.roll(1j*sigma, -1, axis=i))
-    dmy = sys.icffta(np.sum(1j*sys.grid.K_c*np.conj(sys.grid.shiftK_c())*sys.cfftu(dmy), axis=0))
+    dmy = sys.icffta(np.sum(sys.grid.operator('divK_c')*sys.cfftu(dmy), axis=0))
     return dmy
 
-setder = lambda i : "trajectory/frame_" + str(np.int(i))
+setder = lambda i : "trajectory/frame_" + str(int(i))
 def saveh5(i, output, u, phi, position, rotation, velocity, omega, force, torque, \
            concentration, free_charge_density, bound_charge_density, electric_potential, electric_field, eps, f_maxwell, time):
     output.create_group(setder(i))
@@ -237,21 +281,44 @@ def saveh5(i, output, u, phi, position, rotation, velocity, omega, force, torque
 # set parameters
 print("SPM simulatin starts!", flush=True)
 # system 
+# fft backend : 'numpy' transforms into the solver work arrays without allocating only with numpy >= 2 (older numpy
+# allocates each result and copies it, as 'scipy' does), 'scipy' and 'fftw' (e.g. {'backend':'scipy', 'workers':-1})
+# run multithreaded
+fft_backend = 'numpy' if np.lib.NumpyVersion(np.__version__) >= '2.0.0' else 'scipy'
 Np   = 6
 dim  = 2
 if dim==2:
     sys  = spm.SPM2D({'grid':{'powers':[Np,Np], 'dx':0.5},\
                       'particle':{'a':10, 'a_xi':4, 'mass_ratio':1.2},\
-                      'fluid':{'rho':1.0, 'mu':1.0}})
+                      'fluid':{'rho':1.0, 'mu':1.0},\
+                      'assembly':'local', 'fft':{'backend':fft_backend}})
 elif dim==3:
     sys  = spm.SPM3D({'grid':{'powers':[Np,Np,Np], 'dx':0.5},\
                       'particle':{'a':5, 'a_xi':2, 'mass_ratio':1.2},\
-                      'fluid':{'rho':1.0, 'mu':1.0}})
+                      'fluid':{'rho':1.0, 'mu':1.0},\
+                      'assembly':'local', 'fft':{'backend':fft_backend}})
 
-dt        = 1 / (sys.fluid.nu*sys.grid.maxK2())
-phihL     = utils.etdPhi(-sys.fluid.nu*sys.grid.K2*dt)
+dt_stiff  = 1 / (sys.fluid.nu*sys.grid.maxK2()) # explicit viscous stability limit
+# fluid solver : 'etd1' (first order, solverNS), 'etdrk2' or 'etdrk4' (exact linear part, larger dt at equal accuracy)
+fluid_scheme = 'etd1'
+# adaptive time step : dt = dt_max / 2^n chosen each step from the fluid, electromigration and particle speeds (CFL),
+# with the fluid ETD tables cached per level, frames keep the length ngts*dt_stiff. dt_max = dt_growth*dt_stiff with
+# dt_growth a power of two : the etdrk schemes no longer need dt_stiff, dt is then set by the CFL condition, and by
+# the explicit solute diffusion (chargeSolver.maxStep(), unlimited with the 'etd' solute solver). The particle
+# coupling stays first order in dt, with dt = 4*dt_stiff the particle velocities change by a few percent
+dt_growth   = 4 if fluid_scheme in ('etdrk2', 'etdrk4') else 1
+adaptive_dt = dt_growth > 1
+dt          = dt_growth*dt_stiff
+time_step = utils.AdaptiveTimeStep(-sys.fluid.nu*sys.grid.K2, dt, sys.grid.dx, cfl=0.5, \
+                                   nlevels=(8 if adaptive_dt else 1) + int(np.log2(dt_growth)), scheme=fluid_scheme)
+phihL     = time_step.table(0)
+nsSolver  = {'etd1':solverNS, 'etdrk2':solverNS_etdrk2, 'etdrk4':solverNS_etdrk4}[fluid_scheme]
+rotational_advection = False # non-linear term in rotational form, u x omega
 phir      = (lambda x : utils.phiGauss(x, sys.particle.radius, sys.particle.xi, sys.grid.dx))
 phi_sine  = (lambda x : utils.phiSine(x, sys.particle.radius, sys.particle.xi))
+# tabulated (interpolated) profile, with maximum deviation phir.error (phi_sine is kept exact, as the surface
+# normals of makeTanOp amplify round-off differences far from the particles)
+#phir      = utils.tabulatedPhiGauss(sys.particle.radius, sys.particle.xi, sys.grid.dx, kind='cubic')
 
 # electro-property
 # electro-property
@@ -263,9 +330,38 @@ epsilon0 = 1
 coef_E   = 0.5
 coef_n   = 1
 ac_freq  = 1e-1
+externalField = uniform_ElectricField_y # uniform_ElectricField_x, uniform_ElectricField_y or rotating_ElectricField
+ehd_mode = 'instantaneous' # 'instantaneous' : resolve the field oscillation, 'averaged' : cycle averaged force (dt independent of ac_freq)
 time     = 0
 em       = {'epsilon':{'head':.4e-1, 'tail':.4e-1, 'fluid':8e-1}, \
             'sigma'  :{'head':10e-1, 'tail':.1e-1, 'fluid':1e-1}}
+# solute solver : 'euler' (explicit) or 'etd' (bulk diffusion exact, no longer limiting dt), see solute.SoluteSolver
+solute_scheme = 'euler'
+chargeSolver  = solute.SoluteSolver(sys, gamma, ze, kbT, scheme=solute_scheme, complex_field=True)
+
+# poisson solver
+poisson_precond = 'mean' # None, 'mean' or reference permittivity (spectral), 'multigrid' (one V-cycle)
+poisson_solver  = electrostatics.PoissonSolver(precond=poisson_precond, nguess=4) # or electrostatics.MultigridSolver(cycle='V')
+
+# excluded volume : soft core repulsion U(r) = epsilon/2 (1 - r/sigma)^2, with a cell / verlet neighbor list
+repulsion = {'epsilon':1.0, 'sigma':2*sys.particle.radius}
+neighbors = neighbor.NeighborList(sys.grid.length, cutoff=repulsion['sigma'], skin=sys.grid.dx)
+# particle motion : solverParticlePos, or constantPosition (particles, and therefore eps, frozen)
+position_solver = solverParticlePos
+# reuse the unit field potentials while the particle configuration does not change
+# 'solve' : no reuse, 'phasor' : unit field along Ext, 'basis' : unit fields along each axis (any direction / rotating field)
+# only the external field part is reused : the free charge changes every step, so its potential is still solved for
+# (as expensive as a full 'solve') unless the free charge is below the solver tolerance. Reuse therefore only pays off
+# for frozen particles (constantPosition) with negligible free charge, otherwise eps changes every step and the unit
+# fields are solved for on top of the free charge
+potential_mode  = 'solve'
+unit_solver     = electrostatics.PoissonSolver(precond=poisson_precond) # unit field solves of phasor_cache / field_basis
+phasor_cache    = electrostatics.PhasorCache(sys, unit_solver, tol=1e-6)
+field_basis     = electrostatics.FieldBasis(sys, unit_solver, tol=1e-6)
+sweep_solver    = electrostatics.BatchedSolver(precond='mean') # frequency sweeps, see solverPoisson_sweep
+# frequencies of the response spectrum of the initial configuration (saved under 'spectrum'), e.g. np.logspace(-2, 1, 8)
+sweep_frequencies = None
+potentialSolver = {'solve':solverPoisson, 'phasor':solverPoisson_phasor, 'basis':solverPoisson_basis}[potential_mode]
 
 # particle property
 R     = np.ones((1,dim))*sys.grid.length/2
@@ -276,13 +372,12 @@ O     = np.zeros(len(R)) #2d
 
 # field property
 phi                =   sys.makePhi(phir, R)
-PKsole             =   sys.grid._solenoidalProjectorK()
-uk                 =   np.einsum('ij...,j...->i...', PKsole, sys.fftu(sys.makeUp(phir, R, V, O)))
+uk                 =   sys.grid.projectSolenoidal(sys.fftu(sys.makeUp(phir, R, V, O)))
 charge             =   coef_n*np.ones((species, sys.grid.ns[0], sys.grid.ns[1]), dtype='complex128') #2d
 #charge             =   np.ones((species, sys.grid.ns[0], sys.grid.ns[1], sys.grid.ns[2])) #3d
 rho_e              =   sys.makeRhoe_complex(charge, ze, phi)
 
-Ext, potential_ext    =   uniform_ElectricField_y(time, coef_E=coef_E, frequency=ac_freq)
+Ext, potential_ext    =   externalField(time, coef_E=coef_E, frequency=ac_freq)
 phi_s                 =   sys.makePhi(phi_sine, R) 
 eps, deps             =   sys.makeDielectricField_tanh_complex(em, R, Q, phi_s, ac_freq)
 potential, E, rho_b, f_maxwell, rho_e  =   solverPoisson(eps, Ext, rho_e, deps, np.zeros_like(eps))
@@ -293,20 +388,41 @@ nframes = 10
 ngts    = 10
 output_file = "output.hdf5"
 outfh       = h5py.File(output_file, 'w')
-saveh5(0, outfh, sys.ifftu(uk), phi, R, Q, V, O, np.zeros_like(R), np.zeros_like(R), charge, rho_e, rho_b, potential, E, eps, f_maxwell, dt*ngts)
+frame_time  = dt_stiff*ngts
+frame_ticks = time_step.ticks(frame_time)
+saveh5(0, outfh, sys.ifftu(uk), phi, R, Q, V, O, np.zeros_like(R), np.zeros_like(R), charge, rho_e, rho_b, potential, E, eps, f_maxwell, frame_time)
+if sweep_frequencies is not None:
+    spectrum = solverPoisson_sweep(sweep_frequencies, R, Q, phi_s, Ext, rho_e)
+    outfh.create_dataset('spectrum/frequency', data = sweep_frequencies)
+    for i, name in enumerate(['electric_potential', 'electric_field', 'bound_charge_density', 'maxwell_force']):
+        outfh.create_dataset('spectrum/'+name, data = np.stack([response[i] for response in spectrum]))
+    print("sweep iterations = ", sweep_solver.niter[-1], ", matvecs = ", sweep_solver.nmatvec[-1], flush=True)
 
 for frame in range(nframes):
     print("now at loop:",frame, flush=True)
-    for gts in range(ngts):
+    elapsed, nsteps = 0, 0
+    nsolve, nunit   = len(poisson_solver.nmatvec), len(unit_solver.nmatvec)
+    while elapsed < frame_ticks:
+        dt, phihL, ticks = time_step.select(frame_ticks - elapsed, sys.maxSpeeds(uk, V, O) + (chargeSolver.speed(migrationField(E)),) \
+                                            if adaptive_dt else (), chargeSolver.maxStep())
         phi, uk, R, Q, V, O, Fh, Nh, charge, potential, E, rho_e, rho_b, f_maxwell, eps \
-            = solver(phi, uk, R, Q, V, O, charge, E, potential, phir, solverNS, solverParticlePos, solverParticleVel, solverPoisson)
+            = solver(phi, uk, R, Q, V, O, charge, E, potential, phir, nsSolver, position_solver, solverParticleVel, potentialSolver)
+        elapsed += ticks
+        nsteps  += 1
         time += dt
-        Ext, potential_ext  =  uniform_ElectricField_y(time, coef_E=coef_E, frequency=ac_freq)
+        if ehd_mode == 'instantaneous':
+            # in averaged mode the external field stays the phasor at time = 0
+            Ext, potential_ext  =  externalField(time, coef_E=coef_E, frequency=ac_freq)
     saveh5(frame+1, outfh, sys.ifftu(uk), phi, R, Q, V, O, Fh, Nh, charge, rho_e, rho_b, potential, E, eps, f_maxwell, time)
     outfh.flush()
+    print("poisson iterations = ", np.mean(poisson_solver.niter[nsolve:] or [0]), ", matvecs = ", np.mean(poisson_solver.nmatvec[nsolve:] or [0]), \
+          ", unit field solves = ", len(unit_solver.nmatvec) - nunit, ", iterations = ", np.sum(unit_solver.niter[nunit:]), \
+          ", matvecs = ", np.sum(unit_solver.nmatvec[nunit:]), \
+          ", total matvecs per step = ", (np.sum(poisson_solver.nmatvec[nsolve:]) + np.sum(unit_solver.nmatvec[nunit:]))/nsteps, flush=True)
     print("R = ", R[0], flush=True)
 
 outfh.flush()
 outfh.close()
+sys.close()
 
 print("SPM Simulation Ended", flush=True)
@@ -0,0 +1,421 @@
+import numpy as np
+import inspect
+import os
+from scipy.sparse.linalg import LinearOperator, lgmres
+from . import multigrid
+
+# scipy >= 1.12 renamed the relative tolerance of the krylov solvers from tol to rtol
+_rtol = 'rtol' if 'rtol' in inspect.signature(lgmres).parameters else 'tol'
+
+class PoissonOperator:
+    def __init__(self, spm, eps, complex_field=False):
+        """Initialize staggered variable coefficient Poisson operator div(eps grad phi) for given permittivity eps
+
+        The face averaged permittivity and the shifted gradient / divergence symbols are computed once here,
+        and reused for all operator applications until the permittivity changes. eps may carry leading batch axes
+        (e.g. one permittivity per frequency), the operator is then block diagonal and all blocks are applied at once
+
+        Args:
+            spm           : SPM2D or SPM3D object
+            eps           : permittivity field, of shape batch + grid shape
+            complex_field : use full (complex) transforms, as for the a.c. permittivity"""
+        self.spm   = spm
+        self.eps   = eps
+        self.complex_field = complex_field
+        self.shape = eps.shape
+        self.size  = eps.size
+        self.dim   = spm.grid.dim
+        self.batch = eps.shape[:-self.dim]
+        self.axes  = tuple(range(-self.dim, 0)) # grid axes
+        if complex_field:
+            self.gradK, self.divK = spm.grid.operator('gradK_c'), spm.grid.operator('divK_c')
+            self.dtype = np.dtype(complex)
+            self._ffta, self._iffta, self._fftu, self._ifftu = spm.cffta, spm.icffta, spm.cfftu, spm.icfftu
+        else:
+            self.gradK, self.divK = spm.grid.operator('gradK'), spm.grid.operator('divK')
+            self.dtype = np.result_type(eps, float)
+            self._ffta, self._iffta, self._fftu, self._ifftu = spm.ffta, spm.iffta, spm.fftu, spm.ifftu
+        self.eps_face = self.faceAverage(eps)
+
+        # work arrays, so that apply() does not allocate (with the numpy >= 2 and fftw backends, scipy copies into them)
+        self._ak = np.empty(self.batch + self.gradK.shape[1:], dtype=complex)
+        self._uk = np.empty(self.batch + self.gradK.shape,     dtype=complex)
+        self._u  = np.empty(self.batch + (self.dim,) + self.shape[-self.dim:], dtype=self.dtype)
+        self._a  = np.empty(self.shape, dtype=self.dtype)
+
+    def faceAverage(self, a):
+        """Interpolate scalar field a(r) onto the staggered faces, [0.5*(a(r) + a(r + e_i dx))]_i"""
+        return np.stack([0.5*(a + np.roll(a, -1, axis=i)) for i in self.axes], axis=-self.dim-1)
+
+    def gradient(self, phi, out=None):
+        """Compute staggered gradient of scalar field phi(r)"""
+        ak = self._ffta(phi, out=self._ak)
+        np.multiply(self.gradK, np.expand_dims(ak, -self.dim-1), out=self._uk)
+        return self._ifftu(self._uk, out=out)
+
+    def divergence(self, u, out=None):
+        """Compute divergence of staggered vector field u(r)"""
+        uk = self._fftu(u, out=self._uk)
+        uk*= self.divK
+        np.sum(uk, axis=-self.dim-1, out=self._ak)
+        return self._iffta(self._ak, out=out)
+
+    def apply(self, phi, out=None):
+        """Compute div(eps grad phi), with phi given on the grid"""
+        u  = self.gradient(phi, out=self._u)
+        u *= self.eps_face
+        return self.divergence(u, out=out)
+
+    def matvec(self, v):
+        """Compute div(eps grad phi) for flattened field v (the result is a new array, as Krylov solvers keep it)"""
+        self.apply(v.reshape(self.shape), out=self._a)
+        return self._a.reshape(self.size).copy()
+
+    def rhs(self, Ext):
+        """Compute div(eps Ext) for uniform external field Ext"""
+        return self.divergence(self.eps_face*Ext)
+
+    def block(self, index):
+        """Return the operator restricted to the given blocks (index of the flattened batch axes)"""
+        eps = self.eps.reshape((-1,) + self.shape[-self.dim:])[index]
+        return PoissonOperator(self.spm, eps, self.complex_field)
+
+    def multigrid(self, cycle='V'):
+        """Build geometric multigrid for the finite difference counterpart of this operator (same face averaged eps)"""
+        if self.batch:
+            print('multigrid does not support batched permittivities', flush=True)
+            os._exit(1)
+        return multigrid.Multigrid(self.eps_face, self.spm.grid.dx, cycle=cycle)
+
+    def preconditioner(self, scale='mean'):
+        """Build spectral preconditioner from the constant coefficient staggered Laplacian
+
+        Args:
+            scale : 'mean' to scale the Laplacian by the mean permittivity, or reference permittivity value,
+                    or 'multigrid' ('multigrid-F', 'multigrid-W') for one multigrid V (F, W) cycle instead
+        Returns:
+            M(v) = FT^{-1}[FT[v] / (eps_ref (iK shift^*).(iK shift))] for flattened fields v, with zero k=0 mode
+            (and one eps_ref per block for batched permittivities)"""
+        if isinstance(scale, str) and scale.startswith('multigrid'):
+            return self.multigrid(scale[-1] if '-' in scale else 'V').preconditioner(self.shape)
+        eps_ref = np.mean(self.eps, axis=self.axes, keepdims=True) if scale == 'mean' else scale
+        lap     = eps_ref*np.sum(self.divK*self.gradK, axis=0)
+        ilap    = np.zeros_like(lap)
+        ilap[lap != 0] = 1 / lap[lap != 0]
+        def M(v):
+            ak  = self._ffta(v.reshape(self.shape))
+            ak *= ilap
+            return self._iffta(ak).reshape(v.shape)
+        return M
+
+class PoissonSolver:
+    def __init__(self, precond='mean', tol=1e-5, nguess=4):
+        """Initialize lgmres solver for div(eps grad phi) = b, with initial guesses built from the previous solutions
+
+        lgmres builds a new Krylov subspace on each solve (this is not subspace recycling), only the initial guess
+        uses the previous solves: it is the minimal residual combination of the last nguess solutions U (and of the
+        given x0), x0 = U c with c = argmin |b - A U c|, which costs one matvec per vector of U with the new operator A
+        (up to nguess + 1 matvecs per solve)
+
+        Args:
+            precond : None, 'mean' or reference permittivity for the spectral preconditioner
+            tol     : relative tolerance of lgmres
+            nguess  : number of previous solutions spanning the initial guess (0 to only use x0)"""
+        self.precond = precond
+        self.tol     = tol
+        self.nguess  = nguess
+        self.U       = []
+        self.niter   = [] # lgmres outer iterations of each solve (each of up to 30 inner iterations)
+        self.nmatvec = [] # operator applications of each solve, including the initial guess
+        self.info    = [] # lgmres convergence flag of each solve (0 converged, > 0 iterations without convergence)
+
+    def _initialGuess(self, matvec, b, x0):
+        U = [u for u in self.U if u.shape == b.shape] + ([] if x0 is None else [x0])
+        if len(U) == 0:
+            return None
+        U  = np.stack(U, axis=1)
+        AU = np.stack([matvec(u) for u in U.T], axis=1)
+        return U @ np.linalg.lstsq(AU, b, rcond=None)[0]
+
+    def solve(self, op, b, x0=None):
+        """Solve op(phi) = b, and warn when lgmres does not converge
+
+        Args:
+            op : PoissonOperator
+            b  : right hand side
+            x0 : initial guess, e.g. solution of the previous time step
+        Returns:
+            phi(r), with the same mean as x0 (zero without x0), since phi is only defined up to a constant"""
+        count = {'niter':0, 'nmatvec':0}
+        def matvec(v):
+            count['nmatvec'] += 1
+            return op.matvec(v)
+        def callback(rk):
+            count['niter'] += 1
+        A       = LinearOperator((op.size,op.size), matvec=matvec, dtype=op.dtype)
+        M       = None if self.precond is None else \
+                  LinearOperator((op.size,op.size), matvec=op.preconditioner(self.precond), dtype=op.dtype)
+        b       = b.reshape(op.size)
+        mean    = 0 if x0 is None else np.mean(x0.reshape(op.shape), axis=op.axes, keepdims=True)
+        x0      = self._initialGuess(matvec, b, None if x0 is None else x0.reshape(op.size))
+        x, info = lgmres(A, b, x0=x0, M=M, callback=callback, **{_rtol:self.tol})
+        if info != 0:
+            print('warning: poisson solver did not converge (lgmres info = ' + str(info) + ')', flush=True)
+        x       = x.reshape(op.shape)
+        x      += mean - np.mean(x, axis=op.axes, keepdims=True)
+        if self.nguess > 0:
+            self.U = (self.U + [x.reshape(op.size)])[-self.nguess:]
+        self.niter.append(count['niter'])
+        self.nmatvec.append(count['nmatvec'])
+        self.info.append(info)
+        return x
+
+class BatchedSolver:
+    def __init__(self, precond='mean', tol=1e-5, restart=20, maxiter=20):
+        """Initialize batched GMRES for block diagonal operators, e.g. one permittivity per frequency
+
+        Each block has its own (right preconditioned) Arnoldi process and least squares problem, as if solved
+        separately, but all blocks share the operator and preconditioner applications, i.e. the FFTs are batched.
+        Converged blocks are dropped at each restart, so that easy blocks do not iterate as long as the slowest one
+
+        Args:
+            precond : None, 'mean' or reference permittivity for the spectral preconditioner (one per block)
+            tol     : relative tolerance on the residual of each block
+            restart : number of Arnoldi iterations before restart
+            maxiter : maximum number of restarts"""
+        self.precond   = precond
+        self.tol       = tol
+        self.restart   = restart
+        self.maxiter   = maxiter
+        self.niter     = [] # arnoldi iterations of each solve
+        self.nmatvec   = [] # block operator applications of each solve (summed over the blocks)
+        self.residual  = [] # relative residual of each block, for each solve
+        self.converged = [] # convergence of each block, for each solve
+
+    def solve(self, op, b, x0=None):
+        """Solve op(phi) = b for all blocks at once, and warn when some blocks do not converge
+
+        Args:
+            op : PoissonOperator, with leading batch axes
+            b  : right hand side
+            x0 : initial guess
+        Returns:
+            phi(r), with the same mean as x0 (zero without x0) in each block"""
+        nb       = int(np.prod(op.batch))
+        grid     = op.shape[-op.dim:]
+        b        = b.reshape((nb, -1))
+        x        = np.zeros(op.shape, dtype=op.dtype) if x0 is None else np.array(x0, dtype=op.dtype).reshape(op.shape)
+        mean     = np.mean(x, axis=op.axes, keepdims=True)
+        x        = x.reshape((nb,) + grid)
+        bnorm    = np.linalg.norm(b, axis=1)
+        residual = np.zeros(nb)
+        done     = np.zeros(nb, dtype=bool)
+        active   = np.arange(nb)
+        sub      = op if len(op.batch) == 1 else op.block(active)
+        niter    = 0
+        nmatvec  = nb
+        r        = b - sub.apply(x).reshape((nb, -1))
+        for cycle in range(self.maxiter + 1):
+            beta             = np.linalg.norm(r, axis=1)
+            residual[active] = beta
+            done[active]     = beta <= self.tol*bnorm[active]
+            if cycle == self.maxiter or np.all(done):
+                break
+            # restart with the blocks that have not converged yet
+            if np.any(done[active]):
+                keep, beta = ~done[active], beta[~done[active]]
+                active, r  = active[keep], r[keep]
+                sub        = op.block(active)
+            M     = (lambda v: v) if self.precond is None else sub.preconditioner(self.precond)
+            shape = (len(active), -1)
+            # arnoldi process with the hessenberg matrices H reduced to triangular form by givens rotations (c, s)
+            na      = len(active)
+            V       = np.zeros((self.restart+1,) + r.shape, dtype=r.dtype)
+            H       = np.zeros((na, self.restart+1, self.restart), dtype=r.dtype)
+            c, s    = np.zeros((na, self.restart)), np.zeros((na, self.restart), dtype=r.dtype)
+            g       = np.zeros((na, self.restart+1), dtype=r.dtype); g[:,0] = beta
+            V[0]    = r / np.where(beta > 0, beta, 1)[:,None]
+            for j in range(self.restart):
+                w = sub.apply(M(V[j].reshape(sub.shape))).reshape(shape)
+                for i in range(j+1):
+                    H[:,i,j] = np.einsum('bn,bn->b', V[i].conj(), w)
+                    w       -= H[:,i,j,None]*V[i]
+                H[:,j+1,j] = np.linalg.norm(w, axis=1)
+                V[j+1]     = w / np.where(H[:,j+1,j] > 0, H[:,j+1,j], 1)[:,None]
+                for i in range(j):
+                    H[:,i,j], H[:,i+1,j] = c[:,i]*H[:,i,j] + s[:,i]*H[:,i+1,j], -s[:,i].conj()*H[:,i,j] + c[:,i]*H[:,i+1,j]
+                h0, h1     = H[:,j,j], H[:,j+1,j]
+                den        = np.sqrt(np.abs(h0)**2 + np.abs(h1)**2)
+                phase      = np.where(np.abs(h0) > 0, h0 / np.where(np.abs(h0) > 0, np.abs(h0), 1), 1)
+                c[:,j]     = np.where(den > 0, np.abs(h0) / np.where(den > 0, den, 1), 1)
+                s[:,j]     = np.where(den > 0, phase*h1.conj() / np.where(den > 0, den, 1), 0)
+                H[:,j,j], H[:,j+1,j] = phase*den, 0
+                g[:,j+1], g[:,j]     = -s[:,j].conj()*g[:,j], c[:,j]*g[:,j]
+                niter     += 1
+                nmatvec   += na
+                if np.all(np.abs(g[:,j+1]) <= self.tol*bnorm[active]):
+                    break
+            Rj       = H[:,:j+1,:j+1].copy()
+            diag     = np.einsum('bii->bi', Rj)
+            diag[diag == 0] = 1 # blocks with an exact solution in the krylov subspace (zero residual)
+            y        = np.linalg.solve(np.triu(Rj), g[:,:j+1,None])[...,0]
+            x[active] += M(np.einsum('bj,jbn->bn', y, V[:j+1]).reshape(sub.shape))
+            r        = b[active] - sub.apply(x[active]).reshape(shape)
+            nmatvec += na
+        if not np.all(done):
+            print('warning: batched poisson solver did not converge for blocks', np.flatnonzero(~done), flush=True)
+        self.niter.append(niter)
+        self.nmatvec.append(nmatvec)
+        self.residual.append(residual / np.where(bnorm > 0, bnorm, 1))
+        self.converged.append(done)
+        x = x.reshape(op.shape)
+        return x + (mean - np.mean(x, axis=op.axes, keepdims=True))
+
+class MultigridSolver:
+    def __init__(self, cycle='V', tol=1e-5, maxiter=100):
+        """Initialize standalone multigrid solver for div(eps grad phi) = b
+
+        The spectral operator is solved by defect correction, x += w MG(b - A x), with one multigrid cycle of the
+        finite difference operator per iteration. The damping w = 2/(1 + pi^2/4) accounts for the largest ratio
+        between the spectral and finite difference Laplacians, pi^2/4 at the Nyquist frequency
+
+        Args:
+            cycle   : 'V', 'W' or 'F' cycle
+            tol     : relative tolerance on the residual
+            maxiter : maximum number of defect correction iterations"""
+        self.cycle   = cycle
+        self.tol     = tol
+        self.maxiter = maxiter
+        self.damping = 2 / (1 + np.pi**2/4)
+        self.niter   = [] # multigrid cycles of each solve
+        self.nmatvec = [] # operator applications of each solve
+
+    def solve(self, op, b, x0=None):
+        """Solve op(phi) = b
+
+        Args:
+            op : PoissonOperator
+            b  : right hand side
+            x0 : initial guess, e.g. solution of the previous time step
+        Returns:
+            phi(r), with the same mean as x0 (zero without x0), since phi is only defined up to a constant"""
+        mg    = op.multigrid(self.cycle)
+        b     = b.reshape(op.shape)
+        x     = np.zeros(op.shape, dtype=op.dtype) if x0 is None else np.array(x0, dtype=op.dtype).reshape(op.shape)
+        mean  = np.mean(x)
+        bnorm = np.linalg.norm(b)
+        niter = 0
+        r     = b - op.apply(x)
+        while np.linalg.norm(r) > self.tol*bnorm and niter < self.maxiter:
+            x    += self.damping*mg.solve(r)
+            r     = b - op.apply(x)
+            niter+= 1
+        self.niter.append(niter)
+        self.nmatvec.append(niter + 1)
+        return x + (mean - np.mean(x))
+
+class PhasorCache:
+    def __init__(self, spm, solver, tol=1e-6, complex_field=True):
+        """Initialize cache for the potential of a unit, uniform, external field in the current permittivity
+
+        The potential is linear in the external field, so for Ext(t) = E_0(t) e, with fixed direction e and (complex)
+        amplitude E_0(t) = |E| exp(-i w t), phi(t) = E_0(t) phi_e with div(eps grad phi_e) = div(eps e). phi_e is only
+        solved for again when the permittivity, and therefore the particle configuration, changes by more than tol
+
+        Args:
+            spm           : SPM2D or SPM3D object
+            solver        : PoissonSolver or MultigridSolver used for the unit field
+            tol           : relative (max norm) change of eps above which phi_e is recomputed
+            complex_field : use full (complex) transforms, as for the a.c. permittivity"""
+        self.spm           = spm
+        self.solver        = solver
+        self.tol           = tol
+        self.complex_field = complex_field
+        self.eps           = None
+        self.direction     = None
+        self.potential     = None
+        self.nsolve        = 0 # number of unit field solves
+
+    def _changed(self, eps, direction):
+        # the direction (normalized by its largest component) is compared within tol, to ignore round-off
+        if self.eps is None or self.eps.shape != eps.shape or \
+           not np.allclose(direction, self.direction, rtol=0, atol=self.tol):
+            return True
+        return np.max(np.abs(eps - self.eps)) > self.tol*np.max(np.abs(self.eps))
+
+    def update(self, eps, Ext):
+        """Return operator and unit field potential for permittivity eps, with the amplitude of uniform field Ext
+
+        Returns:
+            op, phi_e, b_e, E_0 with op the PoissonOperator, b_e = div(eps e) and Ext = E_0 e"""
+        field     = Ext[(slice(None),) + (0,)*(Ext.ndim-1)]
+        amplitude = field[np.argmax(np.abs(field))]
+        direction = field / (amplitude if amplitude != 0 else 1)
+        if self._changed(eps, direction):
+            self.op        = self.spm.makePoissonOperator(eps, self.complex_field)
+            self.b         = self.op.rhs(direction.reshape((-1,) + (1,)*(Ext.ndim-1)))
+            self.potential = self.solver.solve(self.op, self.b, self.potential)
+            self.eps       = eps.copy()
+            self.direction = direction
+            self.nsolve   += 1
+        return self.op, self.potential, self.b, amplitude
+
+class FieldBasis:
+    def __init__(self, spm, solver, tol=1e-6, complex_field=True):
+        """Initialize superposition basis of the response to unit, uniform, external fields along each axis
+
+        The response is linear in the external field, so for any (complex, possibly rotating) uniform field
+        Ext = sum_i a_i e_i the potential, field and bound charge are the superposition of the responses to the
+        unit fields e_i, which are only solved for again when the permittivity changes by more than tol
+
+        Args:
+            spm           : SPM2D or SPM3D object
+            solver        : PoissonSolver or MultigridSolver used for the unit fields
+            tol           : relative (max norm) change of eps above which the basis is recomputed
+            complex_field : use full (complex) transforms, as for the a.c. permittivity"""
+        self.spm           = spm
+        self.solver        = solver
+        self.tol           = tol
+        self.complex_field = complex_field
+        self.eps           = None
+        self.potentials    = None
+        self.nsolve        = 0 # number of unit field solves
+
+    def update(self, eps, epsilon0=1):
+        """Recompute the basis if eps changed, and return the PoissonOperator for eps"""
+        if self.eps is not None and self.eps.shape == eps.shape and \
+           np.max(np.abs(eps - self.eps)) <= self.tol*np.max(np.abs(self.eps)):
+            return self.op
+        dim       = self.spm.grid.dim
+        self.op   = self.spm.makePoissonOperator(eps, self.complex_field)
+        units     = np.eye(dim).reshape((dim, dim) + (1,)*dim)
+        x0        = [None]*dim if self.potentials is None else self.potentials
+        self.sources    = np.stack([self.op.rhs(e) for e in units])
+        self.potentials = np.stack([self.solver.solve(self.op, b, x) for b,x in zip(self.sources, x0)])
+        self.fields     = np.stack([-self.op.gradient(p) for p in self.potentials])
+        eps_b           = self.op.faceAverage(eps - epsilon0)
+        self.bound      = np.stack([-self.op.divergence(eps_b*(E + e)) for E,e in zip(self.fields, units)])
+        self.eps        = eps.copy()
+        self.nsolve    += dim
+        return self.op
+
+    @staticmethod
+    def amplitude(Ext):
+        """Return the amplitudes a_i of uniform external field Ext = sum_i a_i e_i"""
+        return Ext[(slice(None),) + (0,)*(Ext.ndim-1)]
+
+    def potential(self, a):
+        """Potential induced by external field sum_i a_i e_i"""
+        return np.tensordot(a, self.potentials, axes=1)
+
+    def field(self, a):
+        """Induced (staggered) electric field, without the external field itself"""
+        return np.tensordot(a, self.fields, axes=1)
+
+    def boundCharge(self, a):
+        """Bound charge density -div((eps - epsilon0) (E + Ext))"""
+        return np.tensordot(a, self.bound, axes=1)
+
+    def rhs(self, a):
+        """Right hand side div(eps Ext) of the Poisson equation"""
+        return np.tensordot(a, self.sources, axes=1)
@@ -0,0 +1,98 @@
+import numpy as np
+import os
+
+def _store(a, out):
+    """Return a, copied into out if an output buffer is given"""
+    if out is None:
+        return a
+    out[...] = a
+    return out
+
+class NumpyFFT:
+    def __init__(self, workers=None):
+        """Initialize single threaded FFT backend using numpy.fft
+
+        Only numpy >= 2.0 transforms into out without allocating, older versions allocate the result and copy it"""
+        self.workers = 1
+        self._out    = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+    def _execute(self, transform, a, s, axes, out):
+        """Transform directly into out when numpy.fft supports it (numpy >= 2.0), through a copy otherwise"""
+        if self._out:
+            return transform(a, s, axes=axes, out=out)
+        return _store(transform(a, s, axes=axes), out)
+
+    def rfftn(self, a, axes=None, out=None):
+        return self._execute(np.fft.rfftn, a, None, axes, out)
+    def irfftn(self, a, s, axes=None, out=None):
+        return self._execute(np.fft.irfftn, a, s, axes, out)
+    def fftn(self, a, axes=None, out=None):
+        return self._execute(np.fft.fftn, a, None, axes, out)
+    def ifftn(self, a, s, axes=None, out=None):
+        return self._execute(np.fft.ifftn, a, s, axes, out)
+
+class ScipyFFT:
+    def __init__(self, workers=None):
+        """Initialize multithreaded FFT backend using scipy.fft with given number of workers (default all cores)
+
+        scipy.fft has no output argument, the result is allocated and then copied into out when it is given"""
+        import scipy.fft
+        self._fft    = scipy.fft
+        self.workers = os.cpu_count() if workers is None or workers < 0 else workers
+
+    def rfftn(self, a, axes=None, out=None):
+        return _store(self._fft.rfftn(a, axes=axes, workers=self.workers), out)
+    def irfftn(self, a, s, axes=None, out=None):
+        return _store(self._fft.irfftn(a, s, axes=axes, workers=self.workers), out)
+    def fftn(self, a, axes=None, out=None):
+        return _store(self._fft.fftn(a, axes=axes, workers=self.workers), out)
+    def ifftn(self, a, s, axes=None, out=None):
+        return _store(self._fft.ifftn(a, s, axes=axes, workers=self.workers), out)
+
+class FFTWFFT:
+    def __init__(self, workers=None, effort='FFTW_MEASURE'):
+        """Initialize multithreaded FFT backend using pyFFTW, with plans (and aligned buffers) kept for each transform"""
+        import pyfftw
+        import pyfftw.builders
+        self._fftw   = pyfftw
+        self.workers = os.cpu_count() if workers is None or workers < 0 else workers
+        self.effort  = effort
+        self._plans  = {}
+
+    def _execute(self, builder, dtype, a, s, axes, out):
+        """Copy a into the aligned input buffer of the (cached) plan and return a copy of the transformed output"""
+        a   = np.asarray(a)
+        key = (builder, a.shape, dtype, None if s is None else tuple(s), axes)
+        if key not in self._plans:
+            buf = self._fftw.empty_aligned(a.shape, dtype=dtype)
+            self._plans[key] = getattr(self._fftw.builders, builder)(buf, s=s, axes=axes, threads=self.workers, \
+                                                                     planner_effort=self.effort, avoid_copy=True)
+        plan = self._plans[key]
+        plan.input_array[...] = a
+        return plan().copy() if out is None else _store(plan(), out)
+
+    def rfftn(self, a, axes=None, out=None):
+        return self._execute('rfftn', 'float64', a, None, axes, out)
+    def irfftn(self, a, s, axes=None, out=None):
+        return self._execute('irfftn', 'complex128', a, s, axes, out)
+    def fftn(self, a, axes=None, out=None):
+        return self._execute('fftn', 'complex128', a, None, axes, out)
+    def ifftn(self, a, s, axes=None, out=None):
+        return self._execute('ifftn', 'complex128', a, s, axes, out)
+
+backends = {'numpy':NumpyFFT, 'scipy':ScipyFFT, 'fftw':FFTWFFT}
+
+def backend(name='numpy', **kwargs):
+    """Instantiate FFT backend
+
+    Args:
+        name : 'numpy', 'scipy' or 'fftw'
+        kwargs : backend options (workers, effort)
+    Returns:
+        object with rfftn, irfftn, fftn and ifftn methods, transforming over the given axes
+        (all axes by default) and optionally writing into an output buffer out, directly (without allocating
+        the result) for numpy >= 2 and fftw, through a copy for scipy"""
+    if name not in backends:
+        print('invalid fft backend', flush=True)
+        os._exit(1)
+    return backends[name](**kwargs)
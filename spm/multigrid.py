@@ -0,0 +1,127 @@
+import numpy as np
+
+class Level:
+    def __init__(self, eps_face, h):
+        """Initialize multigrid level for the finite difference operator div(eps grad phi) on a periodic grid
+
+        Args:
+            eps_face : permittivity on the staggered faces, eps_face[i](r) between r and r + e_i h
+            h        : grid spacing"""
+        self.eps_face = eps_face
+        self.h        = h
+        self.dim      = len(eps_face)
+        self.shape    = eps_face.shape[1:]
+        self.eps_back = np.stack([np.roll(eps_face[i], 1, axis=i) for i in range(self.dim)])
+        self.diag     = -np.sum(eps_face + self.eps_back, axis=0)/h**2
+        self.color    = np.indices(self.shape).sum(axis=0) % 2 == 0
+
+    def offdiag(self, x):
+        """Compute off-diagonal part of the operator, sum_i [eps_i(r) x(r + e_i) + eps_i(r - e_i) x(r - e_i)] / h^2"""
+        y = np.zeros(self.shape, dtype=np.result_type(x, self.eps_face))
+        for i in range(self.dim):
+            y += self.eps_face[i]*np.roll(x, -1, axis=i) + self.eps_back[i]*np.roll(x, 1, axis=i)
+        return y/self.h**2
+
+    def apply(self, x):
+        """Compute div(eps grad x)"""
+        return self.offdiag(x) + self.diag*x
+
+    def smooth(self, x, b, sweeps):
+        """Red-black Gauss-Seidel sweeps for div(eps grad x) = b"""
+        for _ in range(sweeps):
+            for mask in (self.color, ~self.color):
+                x[mask] = ((b - self.offdiag(x))/self.diag)[mask]
+        return x
+
+    def coarsen(self):
+        """Build next coarser level, averaging the face permittivity along the face normal and full weighting across"""
+        eps_face = []
+        for i in range(self.dim):
+            e = self.eps_face[i]
+            for j in range(self.dim):
+                if j == i:
+                    e = 0.5*(_take(e, 0, j) + _take(e, 1, j))
+                else:
+                    e = _take(0.25*np.roll(e, 1, axis=j) + 0.5*e + 0.25*np.roll(e, -1, axis=j), 0, j)
+            eps_face.append(e)
+        return Level(np.stack(eps_face), 2*self.h)
+
+def _take(x, offset, axis):
+    """Return every other point of x along axis, starting from offset"""
+    idx       = [slice(None)]*x.ndim
+    idx[axis] = slice(offset, None, 2)
+    return x[tuple(idx)]
+
+def restrict(r):
+    """Full weighting restriction of fine grid field r onto the (even points of the) coarse grid"""
+    for axis in range(r.ndim):
+        r = _take(0.25*np.roll(r, 1, axis=axis) + 0.5*r + 0.25*np.roll(r, -1, axis=axis), 0, axis)
+    return r
+
+def prolong(e):
+    """Linear interpolation of coarse grid field e onto the fine grid"""
+    for axis in range(e.ndim):
+        shape       = list(e.shape)
+        shape[axis]*= 2
+        f           = np.empty(shape, dtype=e.dtype)
+        idx         = [slice(None)]*e.ndim
+        idx[axis]   = slice(0, None, 2)
+        f[tuple(idx)] = e
+        idx[axis]   = slice(1, None, 2)
+        f[tuple(idx)] = 0.5*(e + np.roll(e, -1, axis=axis))
+        e = f
+    return e
+
+class Multigrid:
+    def __init__(self, eps_face, h, cycle='V', presmooth=2, postsmooth=2, coarsest=4):
+        """Initialize periodic geometric multigrid for div(eps grad phi) = b, with real or complex permittivity
+
+        Args:
+            eps_face   : permittivity on the staggered faces (see PoissonOperator.faceAverage)
+            h          : grid spacing
+            cycle      : 'V', 'W' or 'F' cycle
+            presmooth  : number of red-black Gauss-Seidel sweeps before coarse grid correction
+            postsmooth : number of red-black Gauss-Seidel sweeps after coarse grid correction
+            coarsest   : stop coarsening when any axis has at most this many points"""
+        self.cycle      = cycle
+        self.presmooth  = presmooth
+        self.postsmooth = postsmooth
+        self.levels     = [Level(eps_face, h)]
+        while min(self.levels[-1].shape) > coarsest and all(n % 2 == 0 for n in self.levels[-1].shape):
+            self.levels.append(self.levels[-1].coarsen())
+
+        # (pseudo) inverse of the singular, periodic, coarsest operator
+        coarse = self.levels[-1]
+        size   = int(np.prod(coarse.shape))
+        A      = np.stack([coarse.apply(ek.reshape(coarse.shape)).reshape(size) for ek in np.eye(size)], axis=1)
+        self._coarse_inverse = np.linalg.pinv(A)
+
+    def _cycle(self, l, x, b, cycle):
+        level = self.levels[l]
+        if l == len(self.levels) - 1:
+            return (self._coarse_inverse @ b.reshape(-1)).reshape(level.shape)
+        x  = level.smooth(x, b, self.presmooth)
+        rc = restrict(b - level.apply(x))
+        ec = np.zeros_like(rc)
+        if cycle == 'V':
+            ec = self._cycle(l+1, ec, rc, 'V')
+        elif cycle == 'W':
+            ec = self._cycle(l+1, ec, rc, 'W')
+            ec = self._cycle(l+1, ec, rc, 'W')
+        else:
+            ec = self._cycle(l+1, ec, rc, 'F')
+            ec = self._cycle(l+1, ec, rc, 'V')
+        x += prolong(ec)
+        return level.smooth(x, b, self.postsmooth)
+
+    def solve(self, b, x=None):
+        """Apply one multigrid cycle to div(eps grad x) = b, starting from x (zero by default)"""
+        b = np.asarray(b)
+        x = np.zeros(b.shape, dtype=np.result_type(b, self.levels[0].eps_face)) if x is None else x.copy()
+        return self._cycle(0, x, b, self.cycle)
+
+    def preconditioner(self, shape):
+        """Return M(v), one multigrid cycle from zero initial guess, for flattened fields v of given grid shape"""
+        def M(v):
+            return self.solve(v.reshape(shape)).reshape(v.shape)
+        return M
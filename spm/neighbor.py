@@ -0,0 +1,85 @@
+import numpy as np
+import itertools
+from . import utils
+
+class NeighborList:
+    def __init__(self, lbox, cutoff, skin):
+        """Initialize Verlet neighbor list, built from a cell list, for particles in a periodic box
+
+        All pairs closer than cutoff + skin are kept, so that the list stays valid (for pairs closer than cutoff)
+        until some particle has moved by more than skin/2 since the last build
+
+        Args:
+            lbox   : box dimensions
+            cutoff : interaction range
+            skin   : extra range of the list"""
+        self.lbox   = np.asarray(lbox, dtype=float)
+        self.cutoff = cutoff
+        self.skin   = skin
+        self.R0     = None
+        self.pairs  = np.zeros((0,2), dtype=int)
+        self.nbuild = 0 # number of (re)builds
+
+    def _cellPairs(self, R):
+        """Candidate pairs i < j from the same or adjacent cells, or all pairs when the box holds less than 3 cells"""
+        ncell = np.floor(self.lbox / (self.cutoff + self.skin)).astype(int)
+        if np.any(ncell < 3):
+            return np.triu_indices(len(R), k=1)
+        cell  = np.floor(utils.pbc(R, self.lbox) / (self.lbox / ncell)).astype(int) % ncell
+        cells = {}
+        for p, c in enumerate(map(tuple, cell)):
+            cells.setdefault(c, []).append(p)
+        i, j = [], []
+        for c, members in cells.items():
+            for offset in itertools.product((-1, 0, 1), repeat=len(ncell)):
+                others = cells.get(tuple((np.array(c) + offset) % ncell), [])
+                for a in members:
+                    for b in others:
+                        if a < b:
+                            i.append(a)
+                            j.append(b)
+        return np.array(i, dtype=int), np.array(j, dtype=int)
+
+    def build(self, R):
+        """Rebuild the list for particle positions R"""
+        R       = np.asarray(R, dtype=float)
+        i, j    = self._cellPairs(R)
+        r       = np.linalg.norm(utils.distance(R[i], R[j], self.lbox), axis=-1)
+        keep    = r < self.cutoff + self.skin
+        self.pairs   = np.stack([i[keep], j[keep]], axis=-1)
+        self.R0      = R.copy()
+        self.nbuild += 1
+        return self.pairs
+
+    def update(self, R):
+        """Return the neighbor pairs for particle positions R, rebuilding the list only when needed
+
+        Returns:
+            (M,2) array of pairs i < j"""
+        R = np.asarray(R, dtype=float)
+        if self.R0 is None or self.R0.shape != R.shape or \
+           np.max(np.linalg.norm(utils.distance(self.R0, R, self.lbox), axis=-1)) > self.skin/2:
+            return self.build(R)
+        return self.pairs
+
+def softCoreForce(R, pairs, lbox, epsilon, sigma):
+    """Compute soft core repulsive forces, U(r) = epsilon/2 (1 - r/sigma)^2 for r < sigma
+
+    Args:
+        R       : particle positions
+        pairs   : neighbor pairs (see NeighborList.update)
+        lbox    : box dimensions
+        epsilon : strength of the repulsion
+        sigma   : range of the repulsion (contact distance)
+    Returns:
+        forces on all particles"""
+    R      = np.asarray(R, dtype=float)
+    force  = np.zeros_like(R)
+    i, j   = pairs[:,0], pairs[:,1]
+    rij    = utils.distance(R[i], R[j], lbox)
+    r      = np.linalg.norm(rij, axis=-1)
+    sel    = np.logical_and(r < sigma, r > 0)
+    fij    = (epsilon/sigma*(1 - r[sel]/sigma)/r[sel])[:,None]*rij[sel] # force on j
+    np.add.at(force, j[sel],  fij)
+    np.add.at(force, i[sel], -fij)
+    return force
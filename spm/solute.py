@@ -0,0 +1,97 @@
+import numpy as np
+import collections
+import os
+from . import utils
+
+class SoluteSolver:
+    def __init__(self, spm, gamma, ze, kbT, scheme='euler', complex_field=False, cache=4):
+        """Initialize solver for the solute concentrations of all species, dc/dt = -div(flux), with
+        flux = u c - gamma kbT nnsole.grad(c) + gamma ze c nnsole.E and nnsole the tangential projector (makeTanOp)
+
+        All species share the projector and the velocity, and are transformed as one batch
+
+        Args:
+            spm           : SPM2D or SPM3D object
+            gamma         : mobility of each species
+            ze            : charge of each species
+            kbT           : thermal energy
+            scheme        : 'euler' (explicit, dt <= 1/(gamma kbT maxK2)) or 'etd' (bulk diffusion -gamma kbT K2
+                            integrated exactly, advection, migration and the surface correction (nnsole - I) explicit)
+            complex_field : use full (complex) transforms, as for the a.c. concentrations
+            cache         : number of ETD tables kept (one per time step)"""
+        if scheme not in ('euler', 'etd'):
+            print('invalid solute scheme', flush=True)
+            os._exit(1)
+        self.spm           = spm
+        self.gamma         = np.asarray(gamma).reshape(-1)
+        self.ze            = np.asarray(ze).reshape(-1)
+        self.kbT           = kbT
+        self.scheme        = scheme
+        self.complex_field = complex_field
+        self.cache         = cache
+        if complex_field:
+            self._ffta, self._iffta, self._fftu, self._ifftu = spm.cffta, spm.icffta, spm.cfftu, spm.icfftu
+        else:
+            self._ffta, self._iffta, self._fftu, self._ifftu = spm.ffta, spm.iffta, spm.fftu, spm.ifftu
+        self._tables = collections.OrderedDict()
+
+    def maxStep(self):
+        """Largest stable time step, 1/(max(gamma) kbT maxK2) for the explicit scheme, unlimited for 'etd'"""
+        if self.scheme == 'etd':
+            return np.inf
+        return 1 / (np.max(self.gamma)*self.kbT*self.spm.grid.maxK2())
+
+    def speed(self, electric_field):
+        """Maximum electromigration speed, e.g. for the CFL condition of adaptive time steps"""
+        return np.max(np.abs(self.gamma*self.ze))*np.max(np.abs(electric_field))
+
+    def flux(self, charge, u, electric_field, phi_dmy, bulk=True):
+        """Compute the solute fluxes of all species
+
+        Args:
+            charge         : concentrations, one per species
+            u              : fluid velocity
+            electric_field : electric field
+            phi_dmy        : smooth profile of the excluded (particle) domain
+            bulk           : False to leave the bulk diffusion -gamma kbT grad(c) out, (nnsole - I) instead of nnsole
+        Returns:
+            FT[c], FT[flux]"""
+        nnsole  = self.spm.makeTanOp(phi_dmy)
+        g       = self.gamma.reshape((-1,)+(1,)*np.ndim(u))
+        z       = self.ze.reshape((-1,)+(1,)*np.ndim(u))
+        chargek = self._ffta(charge)
+        gradc   = self._ifftu(np.stack([1j*k*chargek for k in self.spm.grid.openK(self.complex_field)], axis=1))
+        diff    = np.einsum("ij..., sj...->si...", nnsole, gradc)
+        if not bulk:
+            diff -= gradc
+        Et      = np.einsum("ij..., j...->i...", nnsole, electric_field)
+        return chargek, self._fftu(u[None,...]*charge[:,None,...] - g*self.kbT*diff + g*z*charge[:,None,...]*Et[None,...])
+
+    def divergenceK(self, fluxk):
+        """Compute K.FT[flux] of all species, with the open wave vector components
+
+        Since FT[div(flux)] = i K.FT[flux], dc/dt = -div(flux) reads d FT[c]/dt = -i K.FT[flux]"""
+        return sum(k*fluxk[:,i] for i,k in enumerate(self.spm.grid.openK(self.complex_field)))
+
+    def table(self, dt):
+        """Return the ETD coefficients [exp(-dt gamma kbT K2), phi_1] of the bulk diffusion, built on first use"""
+        if dt in self._tables:
+            self._tables.move_to_end(dt)
+            return self._tables[dt]
+        K2 = self.spm.grid.operator('K2_c') if self.complex_field else self.spm.grid.K2
+        self._tables[dt] = utils.etdPhi(np.multiply.outer(-self.kbT*self.gamma, K2)*dt)
+        while len(self._tables) > self.cache:
+            self._tables.popitem(last=False)
+        return self._tables[dt]
+
+    def step(self, charge, u, electric_field, phi_dmy, dt):
+        """Advance the concentrations of all species by dt
+
+        Returns:
+            concentrations at t + dt"""
+        if self.scheme == 'euler':
+            chargek, fluxk = self.flux(charge, u, electric_field, phi_dmy)
+            return self._iffta(chargek - dt*1j*self.divergenceK(fluxk))
+        phi            = self.table(dt)
+        chargek, fluxk = self.flux(charge, u, electric_field, phi_dmy, bulk=False)
+        return self._iffta(phi[0]*chargek - dt*phi[1]*1j*self.divergenceK(fluxk))
@@ -1,7 +1,13 @@
 import numpy as np
 import functools
+import collections
+import concurrent.futures
+import threading
 import os
 from . import utils
+from . import fft
+from . import electrostatics
+from . import stencil
 
 class Fluid:
     def __init__(self, mu, rho):
@@ -36,48 +42,173 @@ class Particle3D(Particle):
         self.imoment= 5 / (2*mass*self.radius**2)
 
 
+class OpenMesh(np.lib.mixins.NDArrayOperatorsMixin):
+    def __init__(self, axes):
+        """Initialize separable vector field v_i(r) = axes[i](r_i), without materializing the full meshgrid
+
+        Behaves like the (d, n_1, ..., n_d) array np.meshgrid(*axes, indexing='ij') : v[i] is a read only broadcast
+        view of the i-th component, element-wise operations with scalars and other open meshes stay separable, and
+        other operations (with arrays, or np.asarray(v)) act on the full components
+
+        Args:
+            axes : 1D arrays along each axis"""
+        self.axes  = [np.asarray(a) for a in axes]
+        self.dim   = len(self.axes)
+        self.shape = (self.dim,) + tuple(len(a) for a in self.axes)
+        self.ndim  = len(self.shape)
+        self.dtype = np.result_type(*self.axes)
+
+    def open(self, i):
+        """Return the i-th component as an open (np.ogrid style) array, of length n_i along axis i"""
+        shape    = [1]*self.dim
+        shape[i] = -1
+        return self.axes[i].reshape(shape)
+
+    def __len__(self):
+        return self.dim
+
+    def __getitem__(self, i):
+        return np.broadcast_to(self.open(i), self.shape[1:])
+
+    def __iter__(self):
+        return (self[i] for i in range(self.dim))
+
+    def __array__(self, dtype=None, copy=None):
+        return np.stack(list(self)).astype(dtype if dtype is not None else self.dtype, copy=False)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs:
+            inputs = [np.asarray(x) if isinstance(x, OpenMesh) else x for x in inputs]
+            return getattr(ufunc, method)(*inputs, **kwargs)
+        if all(isinstance(x, OpenMesh) or np.isscalar(x) for x in inputs):
+            return OpenMesh([ufunc(*[x.axes[i] if isinstance(x, OpenMesh) else x for x in inputs]) for i in range(self.dim)])
+        def component(x, i):
+            if isinstance(x, OpenMesh):
+                return x.open(i)
+            x = np.asarray(x)
+            if x.ndim == self.ndim:
+                return x[i] if x.shape[0] == self.dim else x[0]
+            return x
+        return np.stack([np.broadcast_to(ufunc(*[component(x, i) for x in inputs]), self.shape[1:]) for i in range(self.dim)])
+
 class Grid:
-    def __init__(self, powers, dx):
-        """Initialize rectangular grid  of size 2**powers, with grid spacing dx"""                
-        self.ns  = np.array([2**n for n in powers], dtype=np.int)
+    def __init__(self, powers, dx, lazy=False, cache=2**30):
+        """Initialize rectangular grid  of size 2**powers, with grid spacing dx
+
+        Args:
+            lazy  : store only the 1D axes, X, K and K_c being open meshes (see OpenMesh) and K2 computed on demand
+            cache : memory budget (bytes) of the spectral operator cache (see operator)"""
+        self.ns  = np.array([2**n for n in powers], dtype=int)
         self.dx  = dx
         self.dv  = self.dx**self.dim
         self.length = self.ns*self.dx
+        self.lazy   = lazy
+        mesh        = OpenMesh if lazy else (lambda axes: np.array(np.meshgrid(*axes, indexing='ij')))
 
         # init grid
         lattice = list(map(lambda li, ni: np.linspace(0.0, li, ni, endpoint=False), self.length, self.ns))
-        self.X  = np.array(np.meshgrid(*lattice, indexing = 'ij'))
+        self.axes = lattice
+        self.X  = mesh(lattice)
         
         lattice = list(map(lambda ni: np.fft.fftfreq(ni, d=self.dx)*2*np.pi, self.ns[:-1]))
         lattice.append(np.fft.rfftfreq(self.ns[-1], d=self.dx)*2*np.pi)
-        self.K  = np.array(np.meshgrid(*lattice, indexing='ij'))
-        self.K2 = np.einsum('i...,i...->...', self.K, self.K)
+        self.K  = mesh(lattice)
+        self._K2 = None if lazy else np.einsum('i...,i...->...', self.K, self.K)
 
         # new term for a.c.
         lattice  = list(map(lambda ni: np.fft.fftfreq(ni, d=self.dx)*2*np.pi, self.ns))
-        self.K_c = np.array(np.meshgrid(*lattice, indexing='ij'))
+        self.K_c = mesh(lattice)
+
+        # spectral operators, built on first use
+        self.cache      = cache
+        self._operators = collections.OrderedDict()
+        self._builders  = {'shiftK'     : lambda: np.exp(1j*self.K*self.dx/2),
+                           'ishiftK'    : lambda: np.conj(self.operator('shiftK')),
+                           'shiftK_c'   : lambda: np.exp(1j*self.K_c*self.dx/2),
+                           'ishiftK_c'  : lambda: np.conj(self.operator('shiftK_c')),
+                           'gradK'      : lambda: np.asarray(1j*self.K*self.operator('shiftK')),
+                           'divK'       : lambda: np.asarray(1j*self.K*self.operator('ishiftK')),
+                           'gradK_c'    : lambda: np.asarray(1j*self.K_c*self.operator('shiftK_c')),
+                           'divK_c'     : lambda: np.asarray(1j*self.K_c*self.operator('ishiftK_c')),
+                           'iK2'        : lambda: 1 / np.where(self.K2 == 0, 1, self.K2).astype(float),
+                           'K2_c'       : lambda: functools.reduce(lambda a, b: a + b, [k**2 for k in self.openK(True)])}
+
+    def operator(self, name):
+        """Return (read only) spectral operator, built on first use and cached within the memory budget
+
+        The least recently used operators are evicted when the cache exceeds its budget, operators larger than the
+        budget are rebuilt on each call
+
+        Args:
+            name : 'shiftK', 'ishiftK' (conjugate), 'gradK' (iK shift), 'divK' (iK shift^*), 'iK2' (1/K2, with 1/0 = 1),
+                   and 'shiftK_c', 'ishiftK_c', 'gradK_c', 'divK_c', 'K2_c' for all k (complex fields). The solenoidal
+                   projector is applied matrix free (see projectSolenoidal)"""
+        if name in self._operators:
+            self._operators.move_to_end(name)
+            return self._operators[name]
+        if name not in self._builders:
+            print('invalid spectral operator', flush=True)
+            os._exit(1)
+        op     = self._builders[name]()
+        nbytes = sum(a.nbytes for a in op.axes) if isinstance(op, OpenMesh) else op.nbytes
+        if nbytes <= self.cache:
+            if isinstance(op, np.ndarray):
+                op.flags.writeable = False
+            self._operators[name] = op
+            while sum(sum(a.nbytes for a in o.axes) if isinstance(o, OpenMesh) else o.nbytes \
+                      for o in self._operators.values()) > self.cache:
+                self._operators.popitem(last=False)
+        return op
+
+    @property
+    def K2(self):
+        """Squared wave number |K|^2 (computed on each access for lazy grids)"""
+        if self._K2 is not None:
+            return self._K2
+        return functools.reduce(lambda a, b: a + b, [self.K.open(i)**2 for i in range(self.dim)])
 
     def maxK2(self):
         """Compute maximum K2 for pseudo-spectral method"""                        
+        if self.lazy:
+            return sum(np.max(k**2) for k in self.K.axes)
         return self.K2.max()
 
+    def openK(self, complex_field=False):
+        """Return the wave vector components, as open (broadcastable) 1D meshes for lazy grids
+
+        Args:
+            complex_field : K_c for all k (complex fields) instead of K (rfft)
+        Returns:
+            [K_1, K_2, ...]"""
+        K = self.K_c if complex_field else self.K
+        return [K.open(i) for i in range(self.dim)] if self.lazy else list(K)
+
+    def projectSolenoidal(self, uk):
+        """Apply the solenoidal projector P = I - K K / K2 to k-space vector field uk, in place
+
+        Args:
+            uk : FT[u](k), overwritten by FT[P.u](k)
+        Returns:
+            uk"""
+        K   = self.openK()
+        dot = K[0]*uk[0]
+        for i in range(1, self.dim):
+            dot += K[i]*uk[i]
+        dot *= self.operator('iK2')
+        for i in range(self.dim):
+            uk[i] -= K[i]*dot
+        return uk
+
     def shiftK(self):
         """Return phase factors for staggered grid calculations in rfft"""
-        return np.exp(1j*self.K*self.dx/2)
+        return self.operator('shiftK')
 
     def shiftK_c(self):
         """Return phase factors for staggered grid calculations for all k"""
-        return np.exp(1j*self.K_c*self.dx/2)
+        return self.operator('shiftK_c')
 
 class Grid2D(Grid):
     dim = 2
-    def _solenoidalProjectorK(self):
-        """Initialize solenoidal projectors in K-space"""
-        iK2 = 1 / np.where(self.K2 == 0, 1, self.K2).astype(float)
-        Pxx = np.ones_like(self.K[0]) - iK2*self.K[0]**2
-        Pyy = np.ones_like(self.K[1]) - iK2*self.K[1]**2        
-        Pxy = -iK2*self.K[0]*self.K[1]
-        return np.stack([Pxx, Pxy, Pxy, Pyy]).reshape((2,2)+Pxx.shape)
     def x2scalar(self, vx):
         return 0.5*(vx + np.roll(vx,1,axis=0))
     def y2scalar(self, vy):
@@ -87,16 +218,6 @@ class Grid2D(Grid):
 
 class Grid3D(Grid):
     dim = 3
-    def _solenoidalProjectorK(self):
-        """Initialize solenoidal projectors in K-space"""
-        iK2 = 1 / np.where(self.K2 == 0, 1, self.K2).astype(float)
-        Pxx = np.ones_like(self.K[0]) - iK2*self.K[0]**2
-        Pyy = np.ones_like(self.K[1]) - iK2*self.K[1]**2
-        Pzz = np.ones_like(self.K[2]) - iK2*self.K[2]**2
-        Pxy = -iK2*self.K[0]*self.K[1]
-        Pxz = -iK2*self.K[0]*self.K[2]
-        Pyz = -iK2*self.K[1]*self.K[2]
-        return np.stack([Pxx,Pxy,Pxz,Pxy,Pyy,Pyz,Pxz,Pyz,Pzz]).reshape((3,3)+Pxx.shape)
     def x2scalar(self, vx):
         return 0.5*(vx + np.roll(vx,1,axis=0))
     def y2scalar(self, vy):
@@ -107,6 +228,136 @@ class Grid3D(Grid):
         return self.x2scalar(v[0]), self.y2scalar(v[1]), self.z2scalar(v[2])
     
 class SPM:
+    def _setup(self, params):
+        """Initialize optional parameters shared by 2D and 3D SPM objects
+        
+        Args:
+            params['assembly'] : 'grid' (default) evaluates particle fields over the whole grid,
+                                 'local' only over the bounding box of cells of each particle
+            params['fft']      : FFT backend options, e.g. {'backend':'scipy', 'workers':-1} (default numpy)
+            params['cache']    : memory budget in bytes of the particle displacement fields kept between kernels
+                                 (default 2**26, 0 to disable), least recently used fields are evicted first and
+                                 fields larger than the budget (e.g. full grid fields of large grids) are not kept
+            params['workers']  : number of threads assembling particle fields (default 1), each over a contiguous
+                                 chunk of particles, results are reproducible for a given number of workers"""
+        options       = dict(params.get('fft', {}))
+        self.fft      = fft.backend(options.pop('backend', 'numpy'), **options)
+        self._axes    = tuple(range(-self.grid.dim, 0))
+        self._buffers = {}
+        self.assembly = params.get('assembly', 'grid')
+        if self.assembly not in ('grid', 'local'):
+            print('invalid assembly mode', flush=True)
+            os._exit(1)
+        self.cache     = params.get('cache', 2**26)
+        self._geometry = collections.OrderedDict()
+        self._nbytes   = 0 # size of the cached displacement fields
+        self._lock     = threading.Lock()
+        self.workers   = params.get('workers', 1)
+        self._pool     = concurrent.futures.ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+
+    def close(self):
+        """Shut down the assembly threads (params['workers']), particle fields are then assembled serially"""
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    def _map(self, kernel, n):
+        """Apply kernel(start, stop) to contiguous chunks of the n particles, one chunk per worker
+
+        Returns:
+            list of kernel results, in chunk order"""
+        if self._pool is None or n < 2:
+            return [kernel(0, n)]
+        bounds = np.linspace(0, n, min(self.workers, n) + 1).astype(int)
+        return list(self._pool.map(kernel, bounds[:-1], bounds[1:]))
+
+    def _assemble(self, shape, add, *particles):
+        """Sum single particle contributions into a field of given shape
+
+        Each chunk of particles accumulates into a private buffer, add(field, *particle_i), and the buffers are
+        reduced in chunk order"""
+        def chunk(start, stop):
+            field = np.zeros(shape)
+            for p in zip(*(x[start:stop] for x in particles)):
+                add(field, *p)
+            return field
+        return functools.reduce(lambda a, b: a + b, self._map(chunk, len(particles[0])))
+
+    def _particleGeometry(self, Ri, local=False):
+        """Compute (pbc) displacement vectors and distances from particle center to grid points, or return them from
+        the cache when this particle position was already used (least recently used entries are evicted to keep the
+        cache within its memory budget)
+
+        Args:
+            Ri    : particle position vector
+            local : only the grid points in the (periodic) bounding box of cells of the particle
+        Returns:
+            idx, r - Ri, |r - Ri| (read only), with field[idx] the corresponding view of a full grid field"""
+        Ri  = np.asarray(Ri, dtype=float)
+        key = (Ri.tobytes(), local)
+        with self._lock:
+            if key in self._geometry:
+                self._geometry.move_to_end(key)
+                return self._geometry[key]
+        if local:
+            ci, idx = self._particleCell(Ri)
+            dRi = [utils.distance(r, x[i], l) for r, x, i, l in zip(Ri, self.grid.axes, idx, self.grid.length)]
+            idx, dRi = np.ix_(*idx), np.array(np.meshgrid(*dRi, indexing='ij'))
+        else:
+            idx, dRi = (Ellipsis,), self._particleGridDisplacement(Ri)
+        dist = np.linalg.norm(dRi, axis=0)
+        dRi.flags.writeable  = False
+        dist.flags.writeable = False
+        nbytes = dRi.nbytes + dist.nbytes
+        with self._lock:
+            if nbytes <= self.cache and key not in self._geometry:
+                self._geometry[key] = (idx, dRi, dist)
+                self._nbytes       += nbytes
+                while self._nbytes > self.cache:
+                    _, (_, dR, d) = self._geometry.popitem(last=False)
+                    self._nbytes -= dR.nbytes + d.nbytes
+        return idx, dRi, dist
+
+    def _supportWidth(self):
+        """Half width, in grid points, of the local patch around the grid point nearest to a particle"""
+        return int(np.ceil((self.particle.radius + self.particle.xi/2)/self.grid.dx)) + 1
+
+    def _particleCell(self, Ri):
+        """Return nearest grid point ci of particle at Ri, and per axis (periodic) grid indices of its local patch"""
+        nb  = self._supportWidth()
+        ci  = np.rint(np.asarray(Ri)/self.grid.dx).astype(int)
+        idx = [np.arange(c-nb, c+nb+1) % n if 2*nb+1 < n else np.arange(n) for c, n in zip(ci, self.grid.ns)]
+        return ci, idx
+
+    def makeStencils(self, phi, noffsets=8):
+        """Tabulate local stencils of profile phi at sub-cell offsets of the particle center (see stencil.StencilTemplates)
+
+        The returned templates can be passed to makePhi instead of phi, to avoid evaluating phi(r) at every step.
+        Their error attribute bounds the deviation from the exact profile
+
+        Args:
+            phi      : phi(r) function
+            noffsets : number of offset intervals per grid spacing"""
+        nb = self._supportWidth()
+        if np.any(2*nb+1 >= np.asarray(self.grid.ns)):
+            print('particle stencils do not fit in the grid', flush=True)
+            os._exit(1)
+        return stencil.StencilTemplates(phi, self.grid.dx, nb, self.grid.dim, noffsets)
+
+    def _particleSupports(self, R):
+        """Stack compact support indices, displacement vectors and distances of all particles (see _particleGeometry)
+
+        Args:
+            R : particle position vectors
+        Returns:
+            idx, dR, dist with u[(slice(None),) + idx] the values of field u on the supports, of shape (d, P, ...),
+            and dR, dist of shape (P, d, ...) and (P, ...)"""
+        idx, dR, dist = zip(*[self._particleGeometry(Ri, local=True) for Ri in R])
+        return tuple(np.stack(i) for i in zip(*idx)), np.stack(dR), np.stack(dist)
+
     def _particleGridDistance(self, Ri):
         """Compute (pbc) distance from particle center to grid points
         
@@ -114,17 +365,24 @@ class SPM:
             Ri : particle position vector
         Returns:
             r - Ri for all r grid points"""
-        return np.linalg.norm(self._particleGridDisplacement(Ri), axis=0)
+        return self._particleGeometry(Ri)[2]
     
     def makePhi(self, phi, R):
         """Compute phi field for given particle configuration
         
         Args:
-            phi : phi(r) function
+            phi : phi(r) function, or stencil templates (see makeStencils)
             R   : particle position vectors
         Returns:
             phi(r) = \sum_i phi_i(r)"""
-        return functools.reduce(lambda a, b: a + b, map(lambda Ri: phi(self._particleGridDistance(Ri)), R))
+        def add(field, Ri):
+            if isinstance(phi, stencil.StencilTemplates):
+                ci, idx = self._particleCell(Ri)
+                field[np.ix_(*idx)] += phi.stencil(np.asarray(Ri) - ci*self.grid.dx)
+                return
+            idx, dRi, dist = self._particleGeometry(Ri, self.assembly == 'local')
+            field[idx]    += phi(dist)
+        return self._assemble(self.grid.ns, add, R)
 
     def makePhiWall(self, width_wall, axis='y'):
         """Compute phi field for walls
@@ -143,13 +401,13 @@ class SPM:
         else :
             print('invalid wall axis', flush=True)
             os._exit()
-        X           = np.array(self.grid.X[index_wall])
+        X           = self.grid.X.open(index_wall) if self.grid.lazy else self.grid.X[index_wall]
         top_wall    = self.grid.length[index_wall] - width_wall*self.grid.dx
         bottom_wall = width_wall*self.grid.dx
         phir_wall   = (lambda x, width_wall, xi_wall : utils.phiSine(x, width_wall, xi_wall)) 
         phi_top     = 1-phir_wall(X, top_wall,    xi)
         phi_bottom  =   phir_wall(X, bottom_wall, xi)
-        return phi_top+phi_bottom
+        return np.broadcast_to(phi_top+phi_bottom, self.grid.ns).copy()
 
     def makePhi_janus(self, phi, R, N):
         """Compute phi field with janus parameter for given particle configuration
@@ -160,7 +418,9 @@ class SPM:
             N   : particle rotational position vectors
         Returns:
             phi(r) = \sum_i phi_i(r)"""
-        return functools.reduce(lambda a, b: a + b, map(lambda Ri, ni: phi(self._particleGridDistance(Ri))*self._janusmap_tanh(Ri, ni), R, N))
+        def add(field, Ri, ni):
+            field += phi(self._particleGridDistance(Ri))*self._janusmap_tanh(Ri, ni)
+        return self._assemble(self.grid.ns, add, R, N)
 
     def makeUp(self, phi, R, V, O):
         """Compute total particle velocity field for given particle configuration
@@ -172,18 +432,23 @@ class SPM:
             O : particle angular velocities
         Returns:
             up(r) = \sum_i up_i(r)"""
-        def up(Ri, Vi, Oi):
-            dRi = self._particleGridDisplacement(Ri)
-            return phi(np.linalg.norm(dRi, axis=0))*self._particleGridVelocity(dRi, Vi, Oi)
-        
-        return functools.reduce(lambda a, b: a + b, map(lambda Ri,Vi,Oi: up(Ri,Vi,Oi), R, V, O))
+        def add(field, Ri, Vi, Oi):
+            idx, dRi, dist = self._particleGeometry(Ri, self.assembly == 'local')
+            field[(slice(None),) + idx] += phi(dist)*self._particleGridVelocity(dRi, Vi, Oi)
+        return self._assemble((self.grid.dim,) + tuple(self.grid.ns), add, R, V, O)
 
     def normalize(self, x):
         return x / np.linalg.norm(x, axis=-1)[...,None]
 
+    def maxSpeeds(self, uk, V, O):
+        """Maximum fluid and particle (translational and surface) speeds, e.g. for the CFL condition of adaptive time
+        steps"""
+        return np.max(np.abs(self.ifftu(uk))), np.max(np.abs(V), initial=0), \
+               self.particle.radius*np.max(np.abs(O), initial=0)
+
     def _janusmap(self, Ri, ni):
-        r    = self._particleGridDisplacement(Ri)
-        norm = np.linalg.norm(r, axis=0)
+        _, r, norm = self._particleGeometry(Ri)
+        r    = r.copy()
         idx  = norm > 0
         r[:,idx] = r[:,idx] / norm[idx]
         r[:,np.logical_not(idx)] = 0
@@ -196,11 +461,11 @@ class SPM:
     def makeDielectricField(self, electric_property, position, rotation, phi_, particle_id=0):
         avg,delta,test = self._janus(electric_property['epsilon'], position[particle_id], rotation[particle_id], (lambda x: x))
         epsilon = test*phi_+(1-phi_)*electric_property['epsilon']['fluid']
-        d_epsilon       = self.ifftu(1j*self.grid.K*self.grid.shiftK()*self.ffta(epsilon))
+        d_epsilon       = self.ifftu(self.grid.operator('gradK')*self.ffta(epsilon))
         return epsilon, d_epsilon
 
     def _janusmap_tanh(self, Ri, ni):
-        r    = self._particleGridDisplacement(Ri)
+        r    = self._particleGeometry(Ri)[1]
         r    = np.einsum('i,i...->...', ni, r)
         norm = np.linalg.norm(r, axis=0)
         idx  = norm > 0
@@ -217,7 +482,7 @@ class SPM:
     def makeDielectricField_tanh(self, electric_property, position, rotation, phi_, sharpness=200):
         avg,delta,test = self._janus_tanh(electric_property['epsilon'], position, rotation, sharpness)
         epsilon        = test*phi_+(1-phi_)*electric_property['epsilon']['fluid']
-        d_epsilon      = self.ifftu(1j*self.grid.K*self.grid.shiftK()*self.ffta(epsilon))
+        d_epsilon      = self.ifftu(self.grid.operator('gradK')*self.ffta(epsilon))
         return epsilon, d_epsilon
 
     # complex permittivity
@@ -236,7 +501,26 @@ class SPM:
         avg,delta,test = self._janus_tanh_complex(electric_property, position, rotation, frequency, sharpness)
         p_fluid        = self._complex_permittivity(electric_property['epsilon']['fluid'], electric_property['sigma']['fluid'], frequency)
         epsilon        = test*phi_+(1-phi_)*p_fluid
-        d_epsilon      = self.icfftu(1j*self.grid.K_c*self.grid.shiftK_c()*self.cffta(epsilon))
+        d_epsilon      = self.icfftu(self.grid.operator('gradK_c')*self.cffta(epsilon))
+        return epsilon, d_epsilon
+
+    def makeDielectricField_tanh_complex_sweep(self, electric_property, position, rotation, phi_, frequencies, sharpness=200):
+        """Compute complex permittivity fields for several frequencies, with the janus geometry computed only once
+
+        Args:
+            frequencies : frequencies of the a.c. field
+        Returns:
+            epsilon, d_epsilon for each frequency, stacked along a leading axis (see makeDielectricField_tanh_complex)"""
+        p         = electric_property
+        f         = np.asarray(frequencies)[(slice(None),) + (None,)*self.grid.dim]
+        phi_sine  = (lambda x : utils.phiSine(x, self.particle.radius, self.particle.xi))
+        janus     = np.tanh(sharpness*self.makePhi_janus(phi_sine, position, rotation))
+        p_head    = self._complex_permittivity(p['epsilon']['head'],  p['sigma']['head'],  f)
+        p_tail    = self._complex_permittivity(p['epsilon']['tail'],  p['sigma']['tail'],  f)
+        p_fluid   = self._complex_permittivity(p['epsilon']['fluid'], p['sigma']['fluid'], f)
+        test      = (p_head + p_tail)/2 + ((p_head - p_tail)/2)*janus
+        epsilon   = test*phi_+(1-phi_)*p_fluid
+        d_epsilon = self.icfftu(self.grid.operator('gradK_c')*self.cffta(epsilon)[:,None,...])
         return epsilon, d_epsilon
 
     def makeDielectricField_wall_tanh_complex(self, electric_property, position, rotation, _phi, _phi_wall, frequency, wall_prop='head', sharpness=200):
@@ -248,7 +532,7 @@ class SPM:
             print('invalid wall property', flush=True)
             os._exit
         epsilon        = test*_phi + (1-_phi-_phi_wall)*p_fluid + p_wall*_phi_wall
-        d_epsilon      = self.icfftu(1j*self.grid.K_c*self.grid.shiftK_c()*self.cffta(epsilon))
+        d_epsilon      = self.icfftu(self.grid.operator('gradK_c')*self.cffta(epsilon))
         return epsilon, d_epsilon
 
     def makeDielectricField_tanh_complex2(self, electric_property, position, rotation, phi_, frequency, charge, ze=1, D=1, Phi_0=1, sharpness=200):
@@ -263,36 +547,58 @@ class SPM:
         ind_0          = np.logical_not(sigma_f > electric_property['sigma']['fluid'])
         eps_f[ind_0]   = self._complex_permittivity(electric_property['epsilon']['fluid'], electric_property['sigma']['fluid'], frequency)
         epsilon        = test*phi_+(1-phi_)*eps_f
-        d_epsilon      = self.icfftu(1j*self.grid.K_c*self.grid.shiftK_c()*self.cffta(epsilon))
+        d_epsilon      = self.icfftu(self.grid.operator('gradK_c')*self.cffta(epsilon))
         return epsilon, d_epsilon
  
+    def makePoissonOperator(self, eps, complex_field=False):
+        """Build staggered Poisson operator div(eps grad phi) for permittivity eps (see electrostatics.PoissonOperator)"""
+        return electrostatics.PoissonOperator(self, eps, complex_field)
+
+    def makePoissonPreconditioner(self, eps, scale='mean', complex_field=False):
+        """Build spectral preconditioner for div(eps grad phi) = b from the constant coefficient staggered Laplacian
+
+        Args:
+            eps           : permittivity field
+            scale         : 'mean' to scale the Laplacian by the mean permittivity, or reference permittivity value
+            complex_field : use full (complex) transforms, as for the a.c. permittivity
+        Returns:
+            M(v) = FT^{-1}[FT[v] / (eps_ref (iK shift^*).(iK shift))] for flattened fields v, with zero k=0 mode"""
+        return self.makePoissonOperator(eps, complex_field).preconditioner(scale)
+
+    def buffer(self, key, shape, dtype=float):
+        """Return pooled work array for given key, allocated on first use (or when shape / dtype change)"""
+        shape = tuple(shape)
+        if key not in self._buffers or self._buffers[key].shape != shape or self._buffers[key].dtype != dtype:
+            self._buffers[key] = np.empty(shape, dtype=dtype)
+        return self._buffers[key]
+
     # fft for variables have only real values
-    def ffta(self, a):
+    def ffta(self, a, out=None):
         """Fourier transform of scalar field a(r)"""
-        return np.fft.rfftn(a)
-    def iffta(self, a):
+        return self.fft.rfftn(a, axes=self._axes, out=out)
+    def iffta(self, a, out=None):
         """Inverse Fourier transform of scalar field a(k)"""
-        return np.fft.irfftn(a, self.grid.ns)
-    def fftu(self, u):
-        """Fourier transform for vector field u(r) = [u_1(r), u_2(r), ...]"""
-        return np.stack([np.fft.rfftn(ui) for ui in u])
-    def ifftu(self, u):
-        """Inverse Fourier transform for vector field u(k) = [u_1(k), u_2(k), ...]"""
-        return np.stack([np.fft.irfftn(ui, self.grid.ns) for ui in u])
+        return self.fft.irfftn(a, self.grid.ns, axes=self._axes, out=out)
+    def fftu(self, u, out=None):
+        """Fourier transform for vector field u(r) = [u_1(r), u_2(r), ...], batched over all components"""
+        return self.fft.rfftn(np.asarray(u), axes=self._axes, out=out)
+    def ifftu(self, u, out=None):
+        """Inverse Fourier transform for vector field u(k) = [u_1(k), u_2(k), ...], batched over all components"""
+        return self.fft.irfftn(np.asarray(u), self.grid.ns, axes=self._axes, out=out)
 
     # normal fft
-    def cffta(self, a):
+    def cffta(self, a, out=None):
         """Fourier transform of scalar field a(r)"""
-        return np.fft.fftn(a)
-    def icffta(self, a):
+        return self.fft.fftn(a, axes=self._axes, out=out)
+    def icffta(self, a, out=None):
         """Inverse Fourier transform of scalar field a(k)"""
-        return np.fft.ifftn(a, self.grid.ns)
-    def cfftu(self, u):
-        """Fourier transform for vector field u(r) = [u_1(r), u_2(r), ...]"""
-        return np.stack([np.fft.fftn(ui) for ui in u])
-    def icfftu(self, u):
-        """Inverse Fourier transform for vector field u(k) = [u_1(k), u_2(k), ...]"""
-        return np.stack([np.fft.ifftn(ui, self.grid.ns) for ui in u])
+        return self.fft.ifftn(a, self.grid.ns, axes=self._axes, out=out)
+    def cfftu(self, u, out=None):
+        """Fourier transform for vector field u(r) = [u_1(r), u_2(r), ...], batched over all components"""
+        return self.fft.fftn(np.asarray(u), axes=self._axes, out=out)
+    def icfftu(self, u, out=None):
+        """Inverse Fourier transform for vector field u(k) = [u_1(k), u_2(k), ...], batched over all components"""
+        return self.fft.ifftn(np.asarray(u), self.grid.ns, axes=self._axes, out=out)
 
 class SPM2D(SPM):
     def __init__(self, params):
@@ -300,11 +606,13 @@ class SPM2D(SPM):
         if len(params['grid']['powers']) != 2:
             print('expected dim = 2')
             return
-        self.grid     = Grid2D(params['grid']['powers'], params['grid']['dx'])
+        self.grid     = Grid2D(params['grid']['powers'], params['grid']['dx'], params['grid'].get('lazy', False), \
+                               params['grid'].get('cache', 2**30))
         self.fluid    = Fluid(params['fluid']['mu'], params['fluid']['rho'])
         self.particle = Particle2D(params['particle']['a']*self.grid.dx, \
                                    params['particle']['a_xi']*self.grid.dx, \
                                    params['particle']['mass_ratio']*self.fluid.rho)
+        self._setup(params)
     
     def _particleGridDisplacement(self, Ri):
         """Compute (pbc) displacement vector from particle center to grid points"""
@@ -333,12 +641,23 @@ class SPM2D(SPM):
             V : old particle velocities at t_n
             O : old particle angular velocities at t_n"""
         def particleForce(phi, u, Ri, Vi, Oi):
-            dRi = self._particleGridDisplacement(Ri)
-            fp  = -phi(np.linalg.norm(dRi, axis=0))*(self._particleGridVelocity(dRi, Vi, Oi) - u)
+            _, dRi, dist = self._particleGeometry(Ri)
+            fp  = -phi(dist)*(self._particleGridVelocity(dRi, Vi, Oi) - u)
             return np.stack([np.sum(fp, axis=(1,2)), np.array([np.sum(dRi[0,...]*fp[1,...] - dRi[1,...]*fp[0,...]), 0.0])])
-        dvrho = self.grid.dv*self.fluid.rho
-        fp    = np.array([particleForce(phi, u, Ri, Vi, Oi) for Ri,Vi,Oi in zip(R,V,O)])
-        return dvrho*fp[:,0,:], dvrho*fp[:,1,0] # forces & torques
+        def forces(start, stop):
+            Rc, Vc, Oc = R[start:stop], V[start:stop], O[start:stop]
+            if self.assembly == 'local':
+                # all particles of the chunk at once, over their compact supports
+                idx, dR, dist = self._particleSupports(Rc)
+                up = Vc[...,None,None] + np.roll(dR, 1, axis=1)*np.stack([-Oc, Oc], axis=1)[...,None,None]
+                fp = -phi(dist)[:,None,...]*(up - np.moveaxis(u[(slice(None),) + idx], 0, 1))
+                return np.sum(fp, axis=(2,3)), np.sum(dR[:,0]*fp[:,1] - dR[:,1]*fp[:,0], axis=(1,2))
+            fp = np.array([particleForce(phi, u, Ri, Vi, Oi) for Ri,Vi,Oi in zip(Rc,Vc,Oc)])
+            return fp[:,0,:], fp[:,1,0]
+        dvrho   = self.grid.dv*self.fluid.rho
+        R, V, O = np.asarray(R), np.asarray(V), np.asarray(O)
+        F, T    = zip(*self._map(forces, len(R)))
+        return dvrho*np.concatenate(F), dvrho*np.concatenate(T) # forces & torques
 
     def makeAdvectionK(self, uk):
         """Compute non-linear advection terms div(uu)
@@ -347,21 +666,54 @@ class SPM2D(SPM):
             uk : updated total velocity field in k-space
         Returns:
             FT[div(uu)](k)"""
-        u  = self.ifftu(uk)
-        UK = self.fftu([u[0]**2, u[0]*u[1], u[1]**2])
+        u    = self.ifftu(uk)
+        i, j = np.triu_indices(2)
+        UK   = self.fftu(u[i]*u[j])
         return np.stack([UK[0], UK[1], UK[1], UK[2]]).reshape((2,2)+UK[0].shape)
 
     def makeDivAdvectionK(self, uk):
-        u  = self.ifftu(uk)
-        UK = self.fftu([u[0]**2, u[0]*u[1], u[1]**2])
+        u    = self.ifftu(uk)
+        i, j = np.triu_indices(2)
+        UK   = self.fftu(u[i]*u[j])
         return np.stack([self.grid.K[0]*UK[0] + self.grid.K[1]*UK[1], \
                          self.grid.K[0]*UK[1] + self.grid.K[1]*UK[2]])
 
+    def makeProjectedAdvectionK(self, uk, out=None, rotational=False):
+        """Compute projected non-linear term -i P.(K.FT[uu]), without forming the advection tensor
+
+        Args:
+            uk         : updated total velocity field in k-space
+            out        : output buffer (allocated if None), can be uk itself
+            rotational : use rotational form P.FT[u x omega] (the gradient of u^2/2 being removed by P)
+        Returns:
+            out, -FT[P.div(uu)](k)"""
+        K   = self.grid.openK()
+        u   = self.ifftu(uk, out=self.buffer('advection_u', (2,)+tuple(self.grid.ns)))
+        if rotational:
+            w  = self.iffta(1j*(K[0]*uk[1] - K[1]*uk[0]), out=self.buffer('advection_w', self.grid.ns))
+            uu = self.buffer('advection_uu', (2,)+tuple(self.grid.ns))
+            np.multiply(u[1], w, out=uu[0])
+            np.multiply(u[0], w, out=uu[1])
+            uu[1] *= -1
+            out = self.fftu(uu, out=out)
+        else:
+            i, j = np.triu_indices(2)
+            uu   = np.multiply(u[i], u[j], out=self.buffer('advection_uu', (3,)+tuple(self.grid.ns)))
+            UU   = self.fftu(uu, out=self.buffer('advection_UU', (3,)+uk.shape[1:], complex))
+            out  = np.empty_like(UU[:2]) if out is None else out
+            np.multiply(K[0], UU[0], out=out[0])
+            out[0] += K[1]*UU[1]
+            np.multiply(K[0], UU[1], out=out[1])
+            out[1] += K[1]*UU[2]
+            out *= -1j
+        return self.grid.projectSolenoidal(out)
+
     def sloverRotation(self, omega, rotation):
         return omega*(np.dstack([-rotation[:,-1], rotation[:,0]]).reshape(rotation.shape))
 
     def makeTanOp(self, phi_dmy):
-        gradPhi = self.ifftu(1j*np.array(self.grid.K)*self.ffta(phi_dmy)[None,...])
+        phik    = self.ffta(phi_dmy)
+        gradPhi = self.ifftu([1j*k*phik for k in self.grid.openK()])
         norm = np.linalg.norm(gradPhi, axis=0)
         n = gradPhi/np.where(norm == 0, 1, norm).astype(float)
         iid0 = phi_dmy==0
@@ -381,7 +733,7 @@ class SPM2D(SPM):
                 else:
                     _dmy[i] = (vec[i]**2 + np.roll(vec[i], -1, axis=axis)**2)/2
             return (_dmy[0]+_dmy[1])**(1/2)    
-        gradPhi = self.ifftu(1j*np.array(self.grid.K)*self.grid.shiftK()*self.ffta(phi_dmy)[None,...])
+        gradPhi = self.ifftu(self.grid.operator('gradK')*self.ffta(phi_dmy)[None,...])
         for i in range(2):
             norm = _interpolateNorm(gradPhi, axis=i)
             n[i] = gradPhi[i]/np.where(norm == 0, 1, norm).astype(float)
@@ -412,11 +764,13 @@ class SPM3D(SPM):
         if len(params['grid']['powers']) != 3:
             print('expected dim = 3')
             return
-        self.grid = Grid3D(params['grid']['powers'], params['grid']['dx'])
+        self.grid = Grid3D(params['grid']['powers'], params['grid']['dx'], params['grid'].get('lazy', False), \
+                           params['grid'].get('cache', 2**30))
         self.fluid    = Fluid(params['fluid']['mu'], params['fluid']['rho'])
         self.particle = Particle3D(params['particle']['a']*self.grid.dx, \
                                    params['particle']['a_xi']*self.grid.dx, \
                                    params['particle']['mass_ratio']*self.fluid.rho)
+        self._setup(params)
     
     def _particleGridDisplacement(self, Ri):
         """Compute (pbc) distance vector from particle center to grid points"""
@@ -443,13 +797,24 @@ class SPM3D(SPM):
             V : old particle velocities at t_n
             O : old particle angular velocities at t_n"""
         def particleForce(phi, u, Ri, Vi, Oi):
-            dRi = self._particleGridDisplacement(Ri)
-            fpi = -phi(np.linalg.norm(dRi, axis=0)) * (self._particleGridVelocity(dRi, Vi, Oi) - u)
+            _, dRi, dist = self._particleGeometry(Ri)
+            fpi = -phi(dist) * (self._particleGridVelocity(dRi, Vi, Oi) - u)
             dmy = np.stack([np.sum(fpi, axis=(1,2,3)), np.sum(np.cross(dRi, fpi, axis=0), axis=(1,2,3))])
             return dmy
-        dvrho = self.grid.dv*self.fluid.rho
-        fp    = np.array([particleForce(phi, u, Ri, Vi, Oi) for Ri, Vi, Oi in zip(R, V, O)])
-        return dvrho*fp[:,0,:], dvrho*fp[:,1,:]
+        def forces(start, stop):
+            Rc, Vc, Oc = R[start:stop], V[start:stop], O[start:stop]
+            if self.assembly == 'local':
+                # all particles of the chunk at once, over their compact supports
+                idx, dR, dist = self._particleSupports(Rc)
+                up = Vc[...,None,None,None] + np.cross(Oc[...,None,None,None], dR, axis=1)
+                fp = -phi(dist)[:,None,...]*(up - np.moveaxis(u[(slice(None),) + idx], 0, 1))
+                return np.sum(fp, axis=(2,3,4)), np.sum(np.cross(dR, fp, axis=1), axis=(2,3,4))
+            fp = np.array([particleForce(phi, u, Ri, Vi, Oi) for Ri, Vi, Oi in zip(Rc, Vc, Oc)])
+            return fp[:,0,:], fp[:,1,:]
+        dvrho   = self.grid.dv*self.fluid.rho
+        R, V, O = np.asarray(R), np.asarray(V), np.asarray(O)
+        F, T    = zip(*self._map(forces, len(R)))
+        return dvrho*np.concatenate(F), dvrho*np.concatenate(T)
 
     def makeAdvectionK(self, uk):
         """Compute non-linear advection terms div(uu)
@@ -458,12 +823,50 @@ class SPM3D(SPM):
             uk : updated total velocit field in k-space
         Returns:
             FT[div(uu)](k)"""
-        u = self.ifftu(uk)
-        UK= self.fftu([u[0]**2, u[0]*u[1], u[0]*u[2], u[1]**2, u[1]*u[2], u[2]**2])
+        u    = self.ifftu(uk)
+        i, j = np.triu_indices(3)
+        UK   = self.fftu(u[i]*u[j])
         return np.stack([UK[0], UK[1], UK[2], UK[1], UK[3], UK[4], UK[2], UK[4], UK[5]]).reshape((3,3)+UK[0].shape)
 
+    def makeProjectedAdvectionK(self, uk, out=None, rotational=False):
+        """Compute projected non-linear term -i P.(K.FT[uu]), without forming the advection tensor
+
+        Args:
+            uk         : updated total velocity field in k-space
+            out        : output buffer (allocated if None), can be uk itself
+            rotational : use rotational form P.FT[u x omega] (the gradient of u^2/2 being removed by P)
+        Returns:
+            out, -FT[P.div(uu)](k)"""
+        K   = self.grid.openK()
+        u   = self.ifftu(uk, out=self.buffer('advection_u', (3,)+tuple(self.grid.ns)))
+        if rotational:
+            w  = self.buffer('advection_w', (3,)+tuple(self.grid.ns))
+            for i in range(3):
+                j, k = (i+1)%3, (i+2)%3
+                self.iffta(1j*(K[j]*uk[k] - K[k]*uk[j]), out=w[i])
+            uu = self.buffer('advection_uu', (3,)+tuple(self.grid.ns))
+            for i in range(3):
+                j, k = (i+1)%3, (i+2)%3
+                np.multiply(u[j], w[k], out=uu[i])
+                uu[i] -= u[k]*w[j]
+            out = self.fftu(uu, out=out)
+        else:
+            i, j = np.triu_indices(3)
+            pair = np.zeros((3,3), dtype=int)
+            pair[i,j] = pair[j,i] = np.arange(len(i))
+            uu   = np.multiply(u[i], u[j], out=self.buffer('advection_uu', (6,)+tuple(self.grid.ns)))
+            UU   = self.fftu(uu, out=self.buffer('advection_UU', (6,)+uk.shape[1:], complex))
+            out  = np.empty_like(UU[:3]) if out is None else out
+            for i in range(3):
+                np.multiply(K[0], UU[pair[i,0]], out=out[i])
+                out[i] += K[1]*UU[pair[i,1]]
+                out[i] += K[2]*UU[pair[i,2]]
+            out *= -1j
+        return self.grid.projectSolenoidal(out)
+
     def makeTanOp(self, phi_dmy):
-        gradPhi = self.ifftu(1j*np.array(self.grid.K)*self.ffta(phi_dmy)[None,...])
+        phik    = self.ffta(phi_dmy)
+        gradPhi = self.ifftu([1j*k*phik for k in self.grid.openK()])
         norm = np.linalg.norm(gradPhi, axis=0)
         n = gradPhi/np.where(norm == 0, 1, norm).astype(float)
         iid0 = phi_dmy==0
@@ -0,0 +1,50 @@
+import numpy as np
+import itertools
+
+class StencilTemplates:
+    def __init__(self, phi, dx, nb, dim, noffsets=8):
+        """Initialize library of particle profile stencils, tabulated at sub-cell offsets of the particle center
+
+        All particles share the same profile, so on the local (2 nb + 1)^dim patch around the nearest grid point
+        the profile only depends on the offset delta of the particle center from that grid point, |delta_i| <= dx/2.
+        The stencils phi(|m dx - delta|) are tabulated at noffsets + 1 offsets per axis, and blended multilinearly
+        for each particle
+
+        Args:
+            phi      : phi(r) function
+            dx       : grid spacing
+            nb       : half width of the patch, in grid points
+            dim      : dimension
+            noffsets : number of offset intervals per axis"""
+        self.dx       = dx
+        self.nb       = nb
+        self.dim      = dim
+        self.noffsets = noffsets
+        self.h        = dx / noffsets
+        self.offsets  = np.linspace(-dx/2, dx/2, noffsets+1)
+        self._m       = np.array(np.meshgrid(*[np.arange(-nb, nb+1)*dx]*dim, indexing='ij'))
+        self._corners = list(itertools.product((0, 1), repeat=dim))
+        self.table    = np.array([self._exact(phi, np.array(d)) for d in itertools.product(self.offsets, repeat=dim)])
+        self.table    = self.table.reshape((noffsets+1,)*dim + self._m.shape[1:])
+
+        # error bound (per particle) : multilinear interpolation error h^2/8 sum_i max|d^2 phi / d delta_i^2|,
+        # with finite difference second derivatives, or the deviation measured at the centers of the offset cells
+        centers       = self.offsets[:-1] + self.h/2
+        sampled       = max(np.max(np.abs(self.stencil(np.array(d)) - self._exact(phi, np.array(d)))) \
+                            for d in itertools.product(centers, repeat=dim))
+        curvature     = sum(np.max(np.abs(np.diff(self.table, 2, axis=i))) for i in range(dim)) / 8
+        self.error    = max(sampled, curvature)
+
+    def _exact(self, phi, delta):
+        return phi(np.linalg.norm(self._m - delta.reshape((-1,) + (1,)*self.dim), axis=0))
+
+    def stencil(self, delta):
+        """Return the stencil for particle center offset delta from the nearest grid point (multilinear blending)"""
+        t  = (np.asarray(delta) + self.dx/2) / self.h
+        i0 = np.clip(np.floor(t).astype(int), 0, self.noffsets-1)
+        w  = t - i0
+        out = np.zeros(self.table.shape[self.dim:])
+        for c in self._corners:
+            weight = np.prod([wi if ci else 1 - wi for wi, ci in zip(w, c)])
+            out   += weight*self.table[tuple(i0 + c)]
+        return out
@@ -1,4 +1,6 @@
 import numpy as np
+import collections
+import os
 
 def pbc(r, lbox):
     """Enforce periodic boundary conditions on position vector r
@@ -87,3 +89,166 @@ def etdPhi(hL):
     phi0 = np.exp(hL)
     phi1 = calculphi1(hL)
     return np.stack([phi0,phi1])
+
+def etdPhiContour(hL, n=3, npoints=32, radius=1.0):
+    """Phi functions \phi_0(hL), ..., \phi_n(hL) by contour integrals (Kassam & Trefethen, 2005)
+
+    \phi_k(z) is evaluated as the mean of \phi_k over npoints on a circle of given radius centered at z,
+    where the recurrence \phi_{k+1}(w) = (\phi_k(w) - 1/k!) / w does not suffer from cancellation
+
+    Returns:
+        [phi_0(hL), ..., phi_n(hL)], real if hL is real
+    """
+    z    = np.asarray(hL)
+    phis = np.zeros((n+1,)+z.shape, dtype=complex)
+    for r in radius*np.exp(2j*np.pi*(np.arange(npoints) + 0.5)/npoints):
+        w    = z + r
+        phik = np.exp(w)
+        fact = 1.0
+        for k in range(1, n+1):
+            phik  = (phik - 1.0/fact)/w
+            fact *= k
+            phis[k] += phik
+    phis   /= npoints
+    phis[0] = np.exp(z)
+    return phis.real if np.isrealobj(z) else phis
+
+def etdrkCoefficients(hL, scheme='etdrk4', npoints=32):
+    """Coefficients of exponential time differencing Runge-Kutta schemes for du/dt = L u + N(u) (Cox & Matthews, 2002)
+
+    Args:
+        hL      : h L, with L the (diagonal) linear operator and h the time step
+        scheme  : 'etd1', 'etdrk2' or 'etdrk4'
+        npoints : number of contour points (see etdPhiContour)
+    Returns:
+        etd1   : [exp(hL), phi_1(hL)],
+                 u' = exp(hL) u + h phi_1 N(u)
+        etdrk2 : [exp(hL), phi_1(hL), phi_2(hL)],
+                 a  = exp(hL) u + h phi_1 N(u), u' = a + h phi_2 (N(a) - N(u))
+        etdrk4 : [exp(hL), exp(hL/2), Q, f_1, f_2, f_3], with Q = phi_1(hL/2)/2, f_1 = phi_1 - 3 phi_2 + 4 phi_3,
+                 f_2 = phi_2 - 2 phi_3, f_3 = 4 phi_3 - phi_2,
+                 a  = exp(hL/2) u + h Q N(u), b = exp(hL/2) u + h Q N(a), c = exp(hL/2) a + h Q (2 N(b) - N(u)),
+                 u' = exp(hL) u + h [f_1 N(u) + 2 f_2 (N(a) + N(b)) + f_3 N(c)]
+    """
+    if scheme == 'etd1':
+        return etdPhiContour(hL, 1, npoints)
+    elif scheme == 'etdrk2':
+        return etdPhiContour(hL, 2, npoints)
+    elif scheme == 'etdrk4':
+        phi  = etdPhiContour(hL, 3, npoints)
+        half = etdPhiContour(np.asarray(hL)/2, 1, npoints)
+        return np.stack([phi[0], half[0], half[1]/2, phi[1] - 3*phi[2] + 4*phi[3], phi[2] - 2*phi[3], 4*phi[3] - phi[2]])
+    print('invalid etd scheme', flush=True)
+    os._exit(1)
+
+class AdaptiveTimeStep:
+    def __init__(self, L, dt_max, dx, cfl=0.5, nlevels=8, scheme='etd1', cache=4):
+        """Adaptive time step controller, with dt restricted to the levels dt_max / 2^n (n < nlevels)
+
+        The levels tile any multiple of the smallest step exactly, and the ETD coefficient tables of the linear
+        operator are kept for the cache most recently used levels
+
+        Args:
+            L       : linear operator of the fluid step (e.g. -nu K2)
+            dt_max  : largest time step (level 0)
+            dx      : grid spacing
+            cfl     : Courant number, dt max(speeds) <= cfl dx
+            nlevels : number of levels (dt >= dt_max / 2^(nlevels-1), even if the CFL condition is violated)
+            scheme  : 'etd1' (etdPhi), 'etdrk2' or 'etdrk4' (etdrkCoefficients)
+            cache   : number of tables kept"""
+        self.L       = L
+        self.dt_max  = dt_max
+        self.dx      = dx
+        self.cfl     = cfl
+        self.nlevels = nlevels
+        self.scheme  = scheme
+        self.cache   = cache
+        self.nticks  = 2**(nlevels-1) # ticks (smallest time steps) per dt_max
+        self.nbuild  = 0              # number of tables built
+        self.n       = 0              # level of the last selected step
+        self._tables = collections.OrderedDict()
+
+    def table(self, n):
+        """Return ETD coefficient table for the time step of level n, built on first use"""
+        if n in self._tables:
+            self._tables.move_to_end(n)
+            return self._tables[n]
+        hL = self.L*(self.dt_max/2**n)
+        self._tables[n] = etdPhi(hL) if self.scheme == 'etd1' else etdrkCoefficients(hL, self.scheme)
+        self.nbuild += 1
+        while len(self._tables) > self.cache:
+            self._tables.popitem(last=False)
+        return self._tables[n]
+
+    def ticks(self, duration):
+        """Return number of ticks (smallest time steps) in duration, e.g. the length of an output frame"""
+        return int(round(duration*self.nticks/self.dt_max))
+
+    def level(self, speeds=(), dt_limit=np.inf):
+        """Return coarsest level satisfying the CFL condition for given (maximum) speeds, with dt <= dt_limit"""
+        n    = 0
+        vmax = max(speeds, default=0.0)
+        if vmax*self.dt_max > self.cfl*self.dx:
+            n = int(np.ceil(np.log2(vmax*self.dt_max/(self.cfl*self.dx))))
+        if self.dt_max > dt_limit:
+            n = max(n, int(np.ceil(np.log2(self.dt_max/dt_limit) - 1e-12)))
+        return min(n, self.nlevels-1)
+
+    def select(self, remaining, speeds=(), dt_limit=np.inf):
+        """Select time step for given speeds, not exceeding the remaining number of ticks
+
+        Args:
+            remaining : number of ticks left (e.g. in the output frame)
+            speeds    : maximum speeds (CFL condition)
+            dt_limit  : stability limit of the terms integrated explicitly (e.g. explicit diffusion)
+        Returns:
+            dt, ETD coefficient table (see table), and number of ticks of the step (0 when nothing remains)"""
+        n = self.level(speeds, dt_limit)
+        if remaining < 1:
+            self.n = n
+            return 0.0, self.table(n), 0
+        while n < self.nlevels-1 and self.nticks >> n > remaining:
+            n += 1
+        self.n = n
+        return self.dt_max/2**n, self.table(n), self.nticks >> n
+
+class RadialProfile:
+    def __init__(self, phi, a, xi, npoints=256, kind='linear'):
+        """Tabulate smooth profile function across the particle interface, for evaluation by interpolation
+
+        phi(r) is tabulated at npoints equispaced r in [a - xi/2, a + xi/2], and is constant (1 inside, 0 outside)
+        beyond this interval. The error attribute is the maximum deviation from phi, measured between the nodes
+
+        Args:
+            phi     : phi(r) function (e.g. phiSine, phiGauss)
+            a       : particle radius
+            xi      : particle interface thickness
+            npoints : number of table nodes
+            kind    : 'linear' or 'cubic' interpolation
+
+        Returns:
+            callable profile, phi(r) ~ profile(r)"""
+        self.r    = np.linspace(a - xi/2.0, a + xi/2.0, npoints)
+        self.phi  = phi(self.r)
+        self.kind = kind
+        if kind == 'cubic':
+            from scipy.interpolate import CubicSpline
+            self._spline = CubicSpline(self.r, self.phi)
+        elif kind != 'linear':
+            print('invalid interpolation kind', flush=True)
+            os._exit(1)
+        rs         = np.linspace(self.r[0], self.r[-1], 8*(npoints-1)+1)
+        self.error = np.max(np.abs(self(rs) - phi(rs)))
+
+    def __call__(self, r):
+        if self.kind == 'linear':
+            return np.interp(r, self.r, self.phi)
+        return self._spline(np.clip(r, self.r[0], self.r[-1]))
+
+def tabulatedPhiSine(a, xi, npoints=256, kind='linear'):
+    """Tabulated phiSine profile (see RadialProfile)"""
+    return RadialProfile(lambda r: phiSine(r, a, xi), a, xi, npoints, kind)
+
+def tabulatedPhiGauss(a, xi, delta, npoints=256, kind='linear'):
+    """Tabulated phiGauss profile (see RadialProfile)"""
+    return RadialProfile(lambda r: phiGauss(r, a, xi, delta), a, xi, npoints, kind)
@@ -5,19 +5,21 @@ print("ok", flush=True)
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy as sp
 import pandas as pd
 import h5py 
 import functools
 import importlib
 
-from scipy.sparse.linalg import LinearOperator
-from scipy.sparse.linalg import lgmres
-
 import spm.utils as utils
 import spm.spm   as spm
+import spm.electrostatics as electrostatics
+import spm.neighbor as neighbor
+import spm.solute as solute
 def reload():
     importlib.reload(utils)
+    importlib.reload(electrostatics)
+    importlib.reload(neighbor)
+    importlib.reload(solute)
     importlib.reload(spm)
 
 # main function
@@ -27,7 +29,7 @@ def solver(phi, uk, position, rotation, velocity, omega, \
     # 1 - solute concentration
     phi_s               =   sys.makePhi(phi_sine, position) 
     #uk                 *=   sys.grid.shiftK()           #shift
-    charge              =   np.array([solverC(ci, sys.ifftu(uk) , position, sys.grid.xyzScalar(electricfield), gi, zi, phi_s) for ci,gi,zi in zip(charge, gamma, ze)])
+    charge              =   chargeSolver.step(charge, sys.ifftu(uk), sys.grid.xyzScalar(electricfield), phi_s, dt)
     #uk                 *=   np.conj(sys.grid.shiftK())  #recover
     rho_e               =   makeRhoe(charge, ze, phi_s)
     
@@ -47,11 +49,12 @@ def solver(phi, uk, position, rotation, velocity, omega, \
     f_maxwell          +=   multiply_scalar_to_vec_stag(electricfield, rho_e)
     uk                 *=   sys.grid.shiftK()           #shift
     uk                  =   uk + dt*solenoidal_shift(f_maxwell); uk[:,0,0] = 0
-    uk                 *=   np.conj(sys.grid.shiftK())  #recover
+    uk                 *=   sys.grid.operator('ishiftK')  #recover
     
     # 4 - hydrodynamic forces
     u                   =   sys.ifftu(uk)
     force_h, torque_h   =   sys.makeForceHydro(phiFunc, u, position, velocity, omega)
+    force_h            +=   dt*neighbor.softCoreForce(position, neighbors.update(position), sys.grid.length, **repulsion)
     #force_g, torque_g = sys.makeForceGravity(phiFunc, np.array([0.0, -1e-2, 0.0])*(sys.particle.volume*(sys.particle.rho - sys.fluid.rho)), position)
     
     # 5 - update velocities
@@ -59,17 +62,34 @@ def solver(phi, uk, position, rotation, velocity, omega, \
     u                   =   sys.makeUp(phiFunc, position, velocity, omega) - phi[None,...]*u   
     
     # 6 - particle constraint force
-    uk                  = uk + np.einsum('ij...,j...->i...', PKsole, sys.fftu(u)); uk[:,0,0] = 0
+    uk                  = uk + sys.grid.projectSolenoidal(sys.fftu(u)); uk[:,0,0] = 0
     
     return phi, uk, position, rotation, velocity, omega, force_h/dt, torque_h/dt, \
     	   charge, potential, electricfield, rho_e, rho_b, f_maxwell, eps
 
 # fluid & particle dynamics
 def solverNS(uk):
-    gnl    = -1j*np.einsum('ij...,k...,kj...->i...', PKsole, sys.grid.K, sys.makeAdvectionK(uk))
+    gnl    = sys.makeProjectedAdvectionK(uk, out=sys.buffer('gnl', uk.shape, complex), rotational=rotational_advection)
     ukstar = np.stack([phihL[0]*uk_d + dt*phihL[1]*gnl_d for uk_d,gnl_d in zip(uk,gnl)])
     return ukstar
 
+def solverNS_etdrk2(uk):
+    advection = lambda v : sys.makeProjectedAdvectionK(v, rotational=rotational_advection)
+    gnl0   = advection(uk)
+    uka    = phihL[0]*uk + dt*phihL[1]*gnl0
+    return uka + dt*phihL[2]*(advection(uka) - gnl0)
+
+def solverNS_etdrk4(uk):
+    advection = lambda v : sys.makeProjectedAdvectionK(v, rotational=rotational_advection)
+    e1, e2, q, f1, f2, f3 = phihL
+    gnl0   = advection(uk)
+    uka    = e2*uk + dt*q*gnl0
+    gnla   = advection(uka)
+    ukb    = e2*uk + dt*q*gnla
+    gnlb   = advection(ukb)
+    ukc    = e2*uka + dt*q*(2*gnlb - gnl0)
+    return e1*uk + dt*(f1*gnl0 + 2*f2*(gnla + gnlb) + f3*advection(ukc))
+
 def solverEHD(uk, free_charge_density, electricfield, deps):
     def _from_staggered_to_normal(vector):
         dmy = np.zeros_like(vector)
@@ -79,13 +99,13 @@ def solverEHD(uk, free_charge_density, electricfield, deps):
     E_on_normal = _from_staggered_to_normal(electricfield)
     A = free_charge_density[None,...]*E_on_normal
     B = -np.einsum("i...,i...->...", E_on_normal, E_on_normal)*_from_staggered_to_normal(deps)/2
-    return uk + dt*np.einsum('ij...,j...->i...', PKsole, sys.fftu(A+B))
+    return uk + dt*sys.grid.projectSolenoidal(sys.fftu(A+B))
 
 def solenoidal_shift(vec):
-    dmy = np.einsum('i...,i...->...', np.array(sys.grid.K)*np.conj(sys.grid.shiftK()), sys.fftu(vec))
-    dmy = dmy[None,...]*np.array(sys.grid.K)*np.array(sys.grid.shiftK())
-    ik2 = 1 / np.where(sys.grid.K2 == 0, 1, sys.grid.K2).astype(float)
-    return sys.fftu(vec) - dmy*ik2
+    # (iK shift)(iK shift^*) = -K K, with the cached staggered derivative symbols
+    vk  = sys.fftu(vec)
+    dmy = np.einsum('i...,i...->...', sys.grid.operator('divK'), vk)
+    return vk + dmy[None,...]*sys.grid.operator('gradK')*sys.grid.operator('iK2')
 
 def solverParticlePos(position, velocity, rotation, omega):
     position_new = utils.pbc(position + velocity * dt, sys.grid.length)
@@ -130,62 +150,14 @@ def solverC(charge, u, position, electric_field, gamma, ze, phi_dmy):
     C = sys.fftu(-gamma*ze*charge*np.einsum("ij..., j...->i...", nnsole, electric_field))
     return sys.iffta(chargek - dt*1j*np.einsum("i..., i...->...", sys.grid.K, (A-B-C)))
 
-def solverC_shift(charge, u, position, electric_field, gamma, ze, phi_dmy):
-    surface_normal = sys.makeSurfaceNormalShift(phi_dmy)
-    chargek = sys.ffta(charge)       
-    # for Advection term, A     
-    A    = sys.fftu(multiply_scalar_to_vec_stag(u, charge))
-    # for Diffusion term, B
-    B    = gamma*kbT*sys.ifftu(1j*np.array(sys.grid.K)*sys.grid.shiftK()*chargek[None,...])
-    B   += multiply_scalar_to_vec_stag(-electric_field, gamma*ze*charge)
-    dmy  = makeDotProductShift(surface_normal, B, charge)
-    B   -= dmy[None,...]*surface_normal
-    B    = sys.fftu(dmy)
-    #B = sys.fftu(gamma*kbT*np.einsum("ij..., j...->i...", nnsole, sys.ifftu(1j*np.array(sys.grid.K)*chargek[None,...])))
-    #C = sys.fftu(gamma*ze*charge*np.einsum("ij..., j...->i...", nnsole, -electric_field))
-    return sys.iffta(chargek - dt*1j*np.einsum("i..., i...->...", np.array(sys.grid.K)*np.conj(sys.grid.shiftK()), (A-B)))
-
 def solverPoisson(eps, Ext, rho_e, deps):  
-    def mvps(v):
-        w = v.view()
-        w.shape = eps.shape
-        dmy = sys.ifftu(1j*sys.grid.K*sys.grid.shiftK()*sys.ffta(w))
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps + np.roll(eps, -1, axis=i))
-        dmy = sys.iffta(np.sum(1j*sys.grid.K*np.conj(sys.grid.shiftK())*sys.fftu(dmy), axis=0))
-        dmy.shape = (NN)
-        return dmy
-    def rhs():
-        dmy = Ext.copy()
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps + np.roll(eps, -1, axis=i))
-        dmy = sys.iffta(np.sum(1j*sys.grid.K*np.conj(sys.grid.shiftK())*sys.fftu(dmy), axis=0))
-        dmy.shape = (NN)
-        return dmy
-    class gmres_counter(object):
-        def __init__(self, disp=True):
-            self._disp = disp
-            self.niter = 0
-        def __call__(self, rk=None):
-            self.niter += 1
-            if self._disp:
-                print('iter %3i\t error = %.3e / %.3e' % (self.niter, np.max(np.abs(mvps(rk)-b)), np.max(np.abs(A*rk -b))))
-    
-    NN            = np.prod(eps.shape)
-    A             = LinearOperator((NN,NN), matvec=mvps)
-    b             = rhs() - rho_e.reshape(NN)
-    counter       = gmres_counter()
-    pot, exitcode = sp.sparse.linalg.lgmres(A, b, tol=1e-5)#, callback=counter)
-    pot.shape     = eps.shape
-    E             = -sys.ifftu(1j*sys.grid.K*sys.grid.shiftK()*sys.ffta(pot)) 
+    op = sys.makePoissonOperator(eps)
+    b             = op.rhs(Ext) - rho_e
+    pot           = poisson_solver.solve(op, b)
+    E             = -op.gradient(pot)
 
     def bound_charge_solver(E_total, epsilon0):
-        dmy = E_total.copy()
-        eps_minus_eps0 = eps - epsilon0
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps_minus_eps0 + np.roll(eps_minus_eps0, -1, axis=i))
-        dmy = sys.iffta(np.sum(1j*sys.grid.K*np.conj(sys.grid.shiftK())*sys.fftu(dmy), axis=0))
-        return dmy
+        return op.divergence(op.faceAverage(eps - epsilon0)*E_total)
     rho_b   = -bound_charge_solver(E+Ext, 1)
     
     def _solve_maxwell_force(E_, deps_, free_charge):
@@ -212,46 +184,13 @@ def solverPoisson(eps, Ext, rho_e, deps):
     return pot, E, rho_b, f_maxwell_staggered
 
 def solverPoisson2(eps, Ext, rho_e, deps, potential_in):  
-    def mvps(v):
-        w = v.view()
-        w.shape = eps.shape
-        dmy = sys.ifftu(1j*sys.grid.K*sys.grid.shiftK()*sys.ffta(w))
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps + np.roll(eps, -1, axis=i))
-        dmy = sys.iffta(np.sum(1j*sys.grid.K*np.conj(sys.grid.shiftK())*sys.fftu(dmy), axis=0))
-        dmy.shape = (NN)
-        return dmy
-    def rhs():
-        dmy = Ext.copy()
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps + np.roll(eps, -1, axis=i))
-        dmy = sys.iffta(np.sum(1j*sys.grid.K*np.conj(sys.grid.shiftK())*sys.fftu(dmy), axis=0))
-        dmy.shape = (NN)
-        return dmy
-    class gmres_counter(object):
-        def __init__(self, disp=True):
-            self._disp = disp
-            self.niter = 0
-        def __call__(self, rk=None):
-            self.niter += 1
-            if self._disp:
-                print('iter %3i\t error = %.3e / %.3e' % (self.niter, np.max(np.abs(mvps(rk)-b)), np.max(np.abs(A*rk -b))))
-    
-    NN            = np.prod(eps.shape)
-    A             = LinearOperator((NN,NN), matvec=mvps)
-    b             = rhs() - rho_e.reshape(NN)
-    counter       = gmres_counter()
-    pot, exitcode = sp.sparse.linalg.lgmres(A, b, x0=potential_in.reshape(NN), tol=1e-5)#, callback=counter)
-    pot.shape     = eps.shape
-    E             = -sys.ifftu(1j*sys.grid.K*sys.grid.shiftK()*sys.ffta(pot)) 
+    op = sys.makePoissonOperator(eps)
+    b             = op.rhs(Ext) - rho_e
+    pot           = poisson_solver.solve(op, b, potential_in)
+    E             = -op.gradient(pot)
 
     def bound_charge_solver(E_total, epsilon0):
-        dmy = E_total.copy()
-        eps_minus_eps0 = eps - epsilon0
-        for i in range(len(dmy)):
-            dmy[i][...] *= 0.5*(eps_minus_eps0 + np.roll(eps_minus_eps0, -1, axis=i))
-        dmy = sys.iffta(np.sum(1j*sys.grid.K*np.conj(sys.grid.shiftK())*sys.fftu(dmy), axis=0))
-        return dmy
+        return op.divergence(op.faceAverage(eps - epsilon0)*E_total)
     rho_b   = -bound_charge_solver(E+Ext, 1)
     
     def _solve_maxwell_force(E_, deps_, free_charge):
@@ -287,7 +226,7 @@ def uniform_ElectricField_y(coef_E = 1):
     potential_ext = np.array(np.max(sys.grid.X[1]) - sys.grid.X[1])*coef_E
     return Ext, potential_ext
 
-setder = lambda i : "trajectory/frame_" + str(np.int(i))
+setder = lambda i : "trajectory/frame_" + str(int(i))
 def saveh5(i, output, u, phi, position, rotation, velocity, omega, force, torque, \
            concentration, free_charge_density, bound_charge_density, electric_potential, electric_field, eps, f_maxwell, time):
     output.create_group(setder(i))
@@ -316,21 +255,44 @@ def saveh5(i, output, u, phi, position, rotation, velocity, omega, force, torque
 # set parameters
 print("SPM simulatin starts!", flush=True)
 # system 
+# fft backend : 'numpy' transforms into the solver work arrays without allocating only with numpy >= 2 (older numpy
+# allocates each result and copies it, as 'scipy' does), 'scipy' and 'fftw' (e.g. {'backend':'scipy', 'workers':-1})
+# run multithreaded
+fft_backend = 'numpy' if np.lib.NumpyVersion(np.__version__) >= '2.0.0' else 'scipy'
 Np   = 6
 dim  = 2
 if dim==2:
     sys  = spm.SPM2D({'grid':{'powers':[Np,Np], 'dx':0.5},\
                       'particle':{'a':5, 'a_xi':2, 'mass_ratio':1.2},\
-                      'fluid':{'rho':1.0, 'mu':1.0}})
+                      'fluid':{'rho':1.0, 'mu':1.0},\
+                      'assembly':'local', 'fft':{'backend':fft_backend}})
 elif dim==3:
     sys  = spm.SPM3D({'grid':{'powers':[Np,Np,Np], 'dx':0.5},\
                       'particle':{'a':5, 'a_xi':2, 'mass_ratio':1.2},\
-                      'fluid':{'rho':1.0, 'mu':1.0}})
-
-dt        = 1 / (sys.fluid.nu*sys.grid.maxK2())
-phihL     = utils.etdPhi(-sys.fluid.nu*sys.grid.K2*dt)
+                      'fluid':{'rho':1.0, 'mu':1.0},\
+                      'assembly':'local', 'fft':{'backend':fft_backend}})
+
+dt_stiff  = 1 / (sys.fluid.nu*sys.grid.maxK2()) # explicit viscous stability limit
+# fluid solver : 'etd1' (first order, solverNS), 'etdrk2' or 'etdrk4' (exact linear part, larger dt at equal accuracy)
+fluid_scheme = 'etd1'
+# adaptive time step : dt = dt_max / 2^n chosen each step from the fluid, electromigration and particle speeds (CFL),
+# with the fluid ETD tables cached per level, frames keep the length ngts*dt_stiff. dt_max = dt_growth*dt_stiff with
+# dt_growth a power of two : the etdrk schemes no longer need dt_stiff, dt is then set by the CFL condition, and by
+# the explicit solute diffusion (chargeSolver.maxStep(), unlimited with the 'etd' solute solver). The particle
+# coupling stays first order in dt, with dt = 4*dt_stiff the particle velocities change by a few percent
+dt_growth   = 4 if fluid_scheme in ('etdrk2', 'etdrk4') else 1
+adaptive_dt = dt_growth > 1
+dt          = dt_growth*dt_stiff
+time_step = utils.AdaptiveTimeStep(-sys.fluid.nu*sys.grid.K2, dt, sys.grid.dx, cfl=0.5, \
+                                   nlevels=(8 if adaptive_dt else 1) + int(np.log2(dt_growth)), scheme=fluid_scheme)
+phihL     = time_step.table(0)
+nsSolver  = {'etd1':solverNS, 'etdrk2':solverNS_etdrk2, 'etdrk4':solverNS_etdrk4}[fluid_scheme]
+rotational_advection = False # non-linear term in rotational form, u x omega
 phir      = (lambda x : utils.phiGauss(x, sys.particle.radius, sys.particle.xi, sys.grid.dx))
 phi_sine  = (lambda x : utils.phiSine(x, sys.particle.radius, sys.particle.xi))
+# tabulated (interpolated) profile, with maximum deviation phir.error (phi_sine is kept exact, as the surface
+# normals of makeTanOp amplify round-off differences far from the particles)
+#phir      = utils.tabulatedPhiGauss(sys.particle.radius, sys.particle.xi, sys.grid.dx, kind='cubic')
 
 # electro-property
 ze       = np.array([1,-1])[...,None]
@@ -342,6 +304,17 @@ coef_E   = 0.5
 coef_n   = 0.1
 em       = {'epsilon':{'head':10, 'tail':0.1, 'fluid':1}, \
 			'sigma':{'head':0, 'tail':0, 'fluid':0}}
+# solute solver : 'euler' (explicit) or 'etd' (bulk diffusion exact, no longer limiting dt), see solute.SoluteSolver
+solute_scheme = 'euler'
+chargeSolver  = solute.SoluteSolver(sys, gamma, ze, kbT, scheme=solute_scheme)
+
+# poisson solver
+poisson_precond = 'mean' # None, 'mean' or reference permittivity (spectral), 'multigrid' (one V-cycle)
+poisson_solver  = electrostatics.PoissonSolver(precond=poisson_precond, nguess=4) # or electrostatics.MultigridSolver(cycle='V')
+
+# excluded volume : soft core repulsion U(r) = epsilon/2 (1 - r/sigma)^2, with a cell / verlet neighbor list
+repulsion = {'epsilon':1.0, 'sigma':2*sys.particle.radius}
+neighbors = neighbor.NeighborList(sys.grid.length, cutoff=repulsion['sigma'], skin=sys.grid.dx)
 
 # particle property
 R     = np.ones((1,dim))*sys.grid.length/2
@@ -352,8 +325,7 @@ O     = np.zeros(len(R)) #2d
 
 # field property
 phi                =   sys.makePhi(phir, R)
-PKsole             =   sys.grid._solenoidalProjectorK()
-uk                 =   np.einsum('ij...,j...->i...', PKsole, sys.fftu(sys.makeUp(phir, R, V, O)))
+uk                 =   sys.grid.projectSolenoidal(sys.fftu(sys.makeUp(phir, R, V, O)))
 charge             =   coef_n*np.ones((species, sys.grid.ns[0], sys.grid.ns[1])) #2d
 #charge             =   coef_n*np.ones((species, sys.grid.ns[0], sys.grid.ns[1], sys.grid.ns[2])) #3d
 rho_e              =   makeRhoe(charge, ze, phi)
@@ -369,17 +341,26 @@ nframes = 100
 ngts    = 100
 output_file = "output.hdf5"
 outfh       = h5py.File(output_file, 'w')
-saveh5(0, outfh, sys.ifftu(uk), phi, R, Q, V, O, O, O, charge, rho_e, rho_b, potential, sys.grid.xyzScalar(E), eps, sys.grid.xyzScalar(f_maxwell), dt*ngts)
+frame_time  = dt_stiff*ngts
+frame_ticks = time_step.ticks(frame_time)
+saveh5(0, outfh, sys.ifftu(uk), phi, R, Q, V, O, O, O, charge, rho_e, rho_b, potential, sys.grid.xyzScalar(E), eps, sys.grid.xyzScalar(f_maxwell), frame_time)
 
 for frame in range(nframes):
     print("now at loop:",frame, flush=True)
-    for gts in range(ngts):
+    elapsed, nsteps = 0, 0
+    while elapsed < frame_ticks:
+        dt, phihL, ticks = time_step.select(frame_ticks - elapsed, sys.maxSpeeds(uk, V, O) + (chargeSolver.speed(E),) \
+                                            if adaptive_dt else (), chargeSolver.maxStep())
         phi, uk, R, Q, V, O, Fh, Nh, charge, potential, E, rho_e, rho_b, f_maxwell, eps \
-            = solver(phi, uk, R, Q, V, O, charge, E, potential, phir, solverNS, constantRotation, solverParticleVel, solverPoisson2)
-    saveh5(frame+1, outfh, sys.ifftu(uk), phi, R, Q, V, O, Fh, Nh, charge, rho_e, rho_b, potential, sys.grid.xyzScalar(E), eps, sys.grid.xyzScalar(f_maxwell), dt*ngts)
+            = solver(phi, uk, R, Q, V, O, charge, E, potential, phir, nsSolver, constantRotation, solverParticleVel, solverPoisson2)
+        elapsed += ticks
+        nsteps  += 1
+    saveh5(frame+1, outfh, sys.ifftu(uk), phi, R, Q, V, O, Fh, Nh, charge, rho_e, rho_b, potential, sys.grid.xyzScalar(E), eps, sys.grid.xyzScalar(f_maxwell), frame_time)
     outfh.flush()
+    print("poisson iterations = ", np.mean(poisson_solver.niter[-nsteps:]), ", matvecs = ", np.mean(poisson_solver.nmatvec[-nsteps:]), flush=True)
 
 outfh.flush()
 outfh.close()
+sys.close()
 
 print("SPM Simulation Ended", flush=True)